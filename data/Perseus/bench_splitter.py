@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Per-section cost of MilestoneSplitter on the bundled Perseus files.
+
+Compares serializing a transformed section (serialize()) with serializing it split at its milestones
+(split_element(), used by CitationScheme.leaf()), so that the difference is the cost of splitting,
+and of checking the segments against the milestones.
+
+    python bench_splitter.py [-n REPEAT] [files...]
+"""
+import argparse
+import copy
+import os
+import time
+from lxml import etree
+
+from tei import WORKS, TEI_DIV, MilestoneSplitter, serialize, transform
+
+# The milestone that divides sections in each edition
+SPLIT_UNITS = {
+    "Homer": "line",
+}
+
+
+def load_sections(filename):
+    """Parse filename and return its innermost units, transformed."""
+    scheme = WORKS[os.path.basename(filename)]["scheme"]
+    leaf = scheme.levels[-1]
+    sections = []
+    for elem in etree.parse(filename).iter(TEI_DIV):
+        if not leaf.match(elem):
+            continue
+        elem = copy.deepcopy(elem)
+        transform(elem)
+        sections += [elem]
+    return sections
+
+
+def timed(func, items, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        for item in items:
+            func(item)
+    return (time.time() - start) / repeat
+
+
+def bench(filename, repeat):
+    meta = WORKS[os.path.basename(filename)]
+    splitter = MilestoneSplitter("milestone", "unit", SPLIT_UNITS.get(meta["categories"][-1], "para"))
+    sections = load_sections(filename)
+    milestones = sum(len(splitter.split_element(elem)) - 1 for elem in sections)
+
+    serialize_time = timed(serialize, sections, repeat)
+    split_time = timed(splitter.split_element, sections, repeat)
+
+    print "{}: {} sections, {} milestones".format(os.path.basename(filename), len(sections), milestones)
+    print "    serialize():     {:8.1f} us/section  {:8.3f} s total".format(
+        serialize_time / len(sections) * 1e6, serialize_time)
+    print "    split_element(): {:8.1f} us/section  {:8.3f} s total".format(
+        split_time / len(sections) * 1e6, split_time)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="*", default=sorted(WORKS), help="TEI files to split")
+    parser.add_argument("-n", "--repeat", type=int, default=3, help="Number of timed runs over each file")
+    args = parser.parse_args()
+
+    for f in args.files:
+        bench(f, args.repeat)
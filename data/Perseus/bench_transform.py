@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Per-section cost of transform() on the bundled Perseus files.
+
+Each run transforms fresh copies of every innermost unit; copying is not timed.
+
+    python bench_transform.py [-n REPEAT] [files...]
+"""
+import argparse
+import copy
+import os
+import time
+from lxml import etree
+
+from tei import WORKS, TEI_DIV, transform
+
+DEFAULT_FILES = ["tlg0059.tlg030.perseus-eng2.xml", "tlg0016.tlg001.perseus-eng2.xml", "tlg0016.tlg001.perseus-grc2.xml"]
+
+
+def load_units(filename):
+    """Parse filename and return its innermost units, untransformed."""
+    leaf = WORKS[os.path.basename(filename)]["scheme"].levels[-1]
+    return [elem for elem in etree.parse(filename).iter(TEI_DIV) if leaf.match(elem)]
+
+
+def bench(filename, repeat):
+    units = load_units(filename)
+    elements = sum(sum(1 for _ in unit.iter()) for unit in units)
+
+    times = []
+    for _ in range(repeat):
+        copies = [copy.deepcopy(unit) for unit in units]
+        start = time.time()
+        for unit in copies:
+            transform(unit)
+        times += [time.time() - start]
+    best = min(times)
+
+    print "{}: {} units, {} elements".format(os.path.basename(filename), len(units), elements)
+    print "    transform(): {:8.1f} us/unit  {:8.3f} s total (best of {})".format(
+        best / len(units) * 1e6, best, repeat)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="*", default=DEFAULT_FILES, help="TEI files to transform")
+    parser.add_argument("-n", "--repeat", type=int, default=5, help="Number of timed runs over each file")
+    args = parser.parse_args()
+
+    for f in args.files:
+        bench(f, args.repeat)
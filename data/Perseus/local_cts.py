@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+"""
+A CTS resolver for the TEI files in this directory, with the interface of MyCapytain's HttpCtsResolver
+(getMetadata, getTextualNode, getReffs, and siblingsId on passages), so that passages can be resolved offline.
+
+Each file is scanned once for its citable divs, and indexed by reference to the byte range of the div.
+Resolving a passage reads and parses only those bytes.  Indexes are kept in the parse cache, keyed by the file's
+contents, and passages that have been resolved are kept in a least recently used cache.
+
+    python local_cts.py urn:cts:greekLit:tlg0016.tlg001.perseus-eng2:1.1.1
+    python local_cts.py urn:cts:greekLit:tlg0059.tlg030.perseus-eng2 --reffs 1
+"""
+import argparse
+import glob
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict
+from xml.sax.saxutils import unescape
+
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import parse_cache
+
+# Bump when a change to build_index() changes its output
+INDEX_VERSION = 1
+
+DEFAULT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+TEI_NS = "http://www.tei-c.org/ns/1.0"
+TEI = "{%s}" % TEI_NS
+
+# Div tags, and comments so that divs inside them are skipped
+DIV_TAG = re.compile(r"<!--.*?-->|<(/?)div\b([^>]*?)(/?)>", re.S)
+ATTRIBUTE = re.compile(r"""([\w:.-]+)\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+WHITESPACE = re.compile(r"\s+", re.U)
+
+
+class Mimetypes(object):
+    """Export formats, with the values MyCapytain uses"""
+    PLAINTEXT = "text/plain"
+    XML = "text/xml:tei"
+
+
+class Citation(object):
+    """One level of a text's citation scheme"""
+    def __init__(self, name, depth):
+        self.name = name
+        self.depth = depth
+
+    def __repr__(self):
+        return "Citation({!r}, {})".format(self.name, self.depth)
+
+
+class TextMetadata(object):
+    def __init__(self, index):
+        self.id = index["urn"]
+        self.lang = index["lang"]
+        self.title = index["title"]
+        self.filename = index["filename"]
+        self.citation = [Citation(name, depth) for depth, name in enumerate(index["citation"], 1)]
+
+    def __repr__(self):
+        return "TextMetadata({!r})".format(self.id)
+
+
+def _attributes(text):
+    return {m.group(1): unescape(m.group(2) if m.group(2) is not None else m.group(3), {"&quot;": '"', "&apos;": "'"})
+            for m in ATTRIBUTE.finditer(text)}
+
+
+def _header(filename):
+    """:return: title, and citation level names, outermost first"""
+    title = None
+    patterns = []
+    for event, elem in etree.iterparse(filename, events=("start", "end")):
+        if event == "start":
+            if elem.tag == TEI + "body":
+                break
+            continue
+        if elem.tag == TEI + "title" and title is None:
+            title = elem.text
+        elif elem.tag == TEI + "cRefPattern":
+            patterns += [elem.get("n")]
+    # refsDecl lists the deepest level first
+    return title, patterns[::-1]
+
+
+def build_index(filename):
+    """
+    Scan filename for the divs that its citation scheme addresses.
+    :return: dict of urn, lang, title, citation, and
+        offsets: reference -> (start, end) byte offsets of its div.  "" is the whole edition.
+        children: reference -> references one level down, in document order
+        Or None if the file has no CTS edition.
+    """
+    try:
+        title, citation = _header(filename)
+    except etree.XMLSyntaxError:
+        # e.g. an edition that relies on a DTD for its entities
+        return None
+    with open(filename, "rb") as f:
+        data = f.read()
+    body = data.find("<body")
+    if body < 0 or not citation:
+        return None
+
+    index = {"filename": os.path.basename(filename), "title": title, "citation": citation,
+             "urn": None, "lang": None, "offsets": {}, "children": {"": []}}
+    offsets = index["offsets"]
+    children = index["children"]
+    stack = []  # (reference, or None if the div isn't citable, start offset) of each open div
+    seen = set()
+
+    for m in DIV_TAG.finditer(data, body):
+        closing, attributes, empty = m.groups()
+        if attributes is None and not closing:
+            continue  # a comment
+        if closing:
+            ref, start = stack.pop()
+            if ref is not None:
+                offsets[ref] = (start, m.end())
+            if not stack:
+                break
+            continue
+
+        depth = len(stack)
+        ref = None
+        if depth == 0:
+            attrib = _attributes(attributes)
+            index["urn"] = attrib.get("n")
+            index["lang"] = attrib.get("xml:lang")
+            ref = ""
+        elif depth <= len(citation) and stack[-1][0] is not None:
+            n = _attributes(attributes).get("n")
+            parent = stack[-1][0]
+            candidate = n if depth == 1 else u"{}.{}".format(parent, n)
+            # Divs without a number, or with a number already used, can't be cited
+            if n and candidate not in seen:
+                ref = candidate
+                seen.add(ref)
+                children[parent] += [ref]
+                if depth < len(citation):
+                    children[ref] = []
+        if empty:
+            if ref is not None:
+                offsets[ref] = (m.start(), m.end())
+            continue
+        stack += [(ref, m.start())]
+
+    if not index["urn"]:
+        return None
+    return index
+
+
+class _LRU(object):
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.pop(key, None)
+            if value is not None:
+                self._items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+
+class _Text(object):
+    """A text's index, with the order of the references at each level"""
+    def __init__(self, path, index):
+        self.path = path
+        self.index = index
+        self.metadata = TextMetadata(index)
+        self.levels = [[]]
+        parents = [""]
+        for _ in index["citation"]:
+            self.levels += [[c for p in parents for c in index["children"].get(p, [])]]
+            parents = self.levels[-1]
+        self.position = {ref: i for level in self.levels for i, ref in enumerate(level)}
+        self.depth = {ref: depth for depth, level in enumerate(self.levels) for ref in level}
+        self.depth[u""] = 0
+
+    def read(self, ref):
+        start, end = self.index["offsets"][ref]
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            data = f.read(end - start)
+        # The div is parsed on its own, so its namespace is declared around it
+        return etree.fromstring('<wrapper xmlns="{}">{}</wrapper>'.format(TEI_NS, data))[0]
+
+
+class Passage(object):
+    def __init__(self, text, reference, elements, prev_id, next_id):
+        """:param elements: the div of the passage, or the divs of a range"""
+        self.urn = text.metadata.id + (u":" + reference if reference else u"")
+        self.id = self.urn
+        self.reference = reference
+        self.citation = text.metadata.citation
+        self.elements = elements
+        self.prevId = prev_id
+        self.nextId = next_id
+        self._exports = {}
+
+    @property
+    def siblingsId(self):
+        return self.prevId, self.nextId
+
+    def export(self, output=Mimetypes.PLAINTEXT, exclude=("note",)):
+        """
+        :param output: Mimetypes.PLAINTEXT, or Mimetypes.XML
+        :param exclude: for plain text, TEI tags whose text is left out
+        """
+        key = (output, tuple(exclude or ()))
+        if key not in self._exports:
+            if output == Mimetypes.PLAINTEXT:
+                self._exports[key] = self._plaintext(exclude or ())
+            elif output.startswith("text/xml"):
+                self._exports[key] = u"".join(etree.tostring(e, encoding=unicode, with_tail=False)
+                                              for e in self.elements)
+            else:
+                raise ValueError("Can't export to {}".format(output))
+        return self._exports[key]
+
+    def _plaintext(self, exclude):
+        texts = []
+        for elem in self.elements:
+            if exclude:
+                elem = etree.fromstring(etree.tostring(elem))
+                etree.strip_elements(elem, *[TEI + tag for tag in exclude], with_tail=False)
+            texts += [u"".join(elem.itertext())]
+        return WHITESPACE.sub(u" ", u" ".join(texts)).strip()
+
+    def __repr__(self):
+        return "Passage({!r})".format(self.urn)
+
+
+class LocalCtsResolver(object):
+    def __init__(self, directory=DEFAULT_DIRECTORY, cache=None, cache_size=256):
+        """
+        :param directory: directory of TEI files
+        :param cache: ParseCache to keep file indexes in, or None to index the files each time
+        :param cache_size: number of passages to keep
+        """
+        self._texts = {}
+        self._passages = _LRU(cache_size)
+        for path in sorted(glob.glob(os.path.join(directory, "*.xml"))):
+            if cache is None:
+                index = build_index(path)
+            else:
+                index = cache.cached(cache.key(path, INDEX_VERSION, "cts"), build_index, path)
+            if index:
+                self._texts[index["urn"]] = _Text(path, index)
+
+    def _text(self, textId):
+        try:
+            return self._texts[textId]
+        except KeyError:
+            raise KeyError(u"Unknown text {}".format(textId))
+
+    @staticmethod
+    def _split_urn(textId, subreference):
+        # urn:cts:namespace:work:passage
+        parts = textId.split(u":")
+        if len(parts) > 4 and subreference is None:
+            return u":".join(parts[:4]), parts[4]
+        return textId, subreference
+
+    def getMetadata(self, objectId=None):
+        """:return: TextMetadata of a text, or if objectId is None, dict of urn to TextMetadata of every text"""
+        if objectId is None:
+            return {urn: text.metadata for urn, text in self._texts.iteritems()}
+        return self._text(objectId).metadata
+
+    def getTextualNode(self, textId, subreference=None, prevnext=False, metadata=False):
+        """
+        :param subreference: reference, e.g. 1.2.3, or range of references at the same level, e.g. 1.2.3-1.2.5.
+            None for the whole text.
+        :param prevnext, metadata: accepted for compatibility.  Siblings and citation are always included.
+        :return: Passage
+        """
+        textId, subreference = self._split_urn(textId, subreference)
+        key = (textId, subreference or u"")
+        passage = self._passages.get(key)
+        if passage is None:
+            passage = self._passage(self._text(textId), subreference or u"")
+            self._passages.put(key, passage)
+        return passage
+
+    def _passage(self, text, reference):
+        first, _, last = reference.partition(u"-")
+        last = last or first
+        for ref in (first, last):
+            if ref not in text.index["offsets"]:
+                raise KeyError(u"No passage {} in {}".format(ref, text.metadata.id))
+        depth = text.depth[first]
+        if text.depth[last] != depth:
+            raise ValueError(u"{} and {} are at different levels".format(first, last))
+        if not first:
+            return Passage(text, reference, [text.read(u"")], None, None)
+
+        level = text.levels[depth]
+        start, end = text.position[first], text.position[last]
+        if end < start:
+            raise ValueError(u"{} comes after {}".format(first, last))
+        elements = [text.read(ref) for ref in level[start:end + 1]]
+        prev_id = level[start - 1] if start > 0 else None
+        next_id = level[end + 1] if end + 1 < len(level) else None
+        return Passage(text, reference, elements, prev_id, next_id)
+
+    def getReffs(self, textId, level=1, subreference=None):
+        """
+        :param level: number of levels below subreference to list
+        :return: list of references, in document order
+        """
+        textId, subreference = self._split_urn(textId, subreference)
+        text = self._text(textId)
+        refs = [subreference or u""]
+        if refs[0] not in text.index["offsets"]:
+            raise KeyError(u"No passage {} in {}".format(refs[0], textId))
+        for _ in range(level):
+            refs = [c for ref in refs for c in text.index["children"].get(ref, [])]
+        return refs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("urn", help="Text or passage urn, e.g. urn:cts:greekLit:tlg0016.tlg001.perseus-eng2:1.1.1")
+    parser.add_argument("--reffs", type=int, metavar="LEVEL", help="List references this many levels down, instead")
+    parser.add_argument("--xml", action="store_true", help="Print TEI rather than plain text")
+    parser.add_argument("-d", "--directory", default=DEFAULT_DIRECTORY, help="Directory of TEI files")
+    parser.add_argument("--cache-dir", default=parse_cache.DEFAULT_DIRECTORY, help="Parse cache directory")
+    args = parser.parse_args()
+
+    resolver = LocalCtsResolver(args.directory, parse_cache.ParseCache(args.cache_dir))
+    if args.reffs:
+        print u"\n".join(resolver.getReffs(args.urn, args.reffs)).encode("utf-8")
+    else:
+        passage = resolver.getTextualNode(args.urn)
+        print passage.export(Mimetypes.XML if args.xml else Mimetypes.PLAINTEXT).encode("utf-8")
+        print passage.siblingsId
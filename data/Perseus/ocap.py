@@ -2,7 +2,8 @@ from MyCapytain.resolvers.cts.api import HttpCtsResolver
 from MyCapytain.retrievers.cts5 import HttpCtsRetriever
 from MyCapytain.common.constants import Mimetypes
 
-# We set up a resolver which communicates with an API available in Leipzig
+# We set up a resolver which communicates with an API available in Leipzig.
+# For the texts bundled in this directory, local_cts.LocalCtsResolver() has the same interface and works offline.
 resolver = HttpCtsResolver(HttpCtsRetriever("http://cts.dh.uni-leipzig.de/api/cts"))
 # We require some metadata information
 textMetadata = resolver.getMetadata("urn:cts:latinLit:phi1294.phi002.perseus-lat2")
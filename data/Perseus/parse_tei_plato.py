@@ -1,246 +1,214 @@
 # -*- coding: utf-8 -*-
+"""
+Load the Perseus TEI editions.  Parsing is in tei.py.  The Sefaria model is only set up once there's a record to write,
+so the parser processes don't set it up, and a dry run, which writes the jagged arrays as json instead, never does.
+
+    python parse_tei_plato.py [sources...]
+    python parse_tei_plato.py --dry-run - tlg0016.tlg001.perseus-eng2.xml
+    python parse_tei_plato.py --aligned --alignment histories.json tlg0016.tlg001.perseus-*.xml
+"""
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+import sys
 
-from bs4 import BeautifulSoup
-from lxml import etree
-import regex
-import django
-django.setup()
-from sefaria.model import *
-
-CLOSING_TAG = "</%s>"
-OPENING_TAG = '<%s%s>'
-ATTRIBUTE = ' %s="%s"'
-
-
-class MilestoneSplitter(object):
-    """Split files at milestone tag."""
-    def __init__(self,
-                 milestone_tag,
-                 identifying_attr = None,
-                 identifying_val = None,
-                 ):
-        self.milestone_tag = milestone_tag
-        self.identifying_attr = identifying_attr
-        self.identifying_val = identifying_val
-        self.count = 0
-        self.parts = []
-        self.milestones = []
-
-    def clear_parts(self):
-        """Clear the parts dictionary.
-        This resets the splitter for the next file."""
-        self.parts = []
-        self.milestones = []
-        self.count = 0
-
-    def split(self, input):
-        """Split single file."""
-        self.clear_parts()
-
-        # Put the M + 1 textual segments in self.parts[]
-        self.split_raw(input)
-
-        # Analyze each Milestone to determine structure
-        tree = etree.fromstring(input)
-        if self.identifying_attr:
-            xpath = './/{}[@{}="{}"]'.format(self.milestone_tag, self.identifying_attr, self.identifying_val)
-        else:
-            xpath = './/{}'.format(self.milestone_tag)
-
-        # Collect all M milestones in self.milestones[]
-        self.milestones = [self.get_parents(m) for m in tree.findall(xpath)]
-
-        # In between parts[x] and parts[x+1] is milestone[x]
-
-        # Add ending tags to all but last one
-        for i in range(0, len(self.parts) - 1):
-            self.parts[i] = self.parts[i] + u"\n" + self.create_closing_tags(self.milestones[i])
-
-        # Add starting tags to all but first one
-        for i in range(1, len(self.parts)):
-            self.parts[i] = self.create_opening_tags(self.milestones[i-1]) + u"\n" + self.parts[i]
-
-        return self.parts
-
-    def split_raw(self, text):
-        """
-            Split the raw text of the file by milestone.
-            Returns M+1 Units
-        """
-        if self.identifying_attr:
-            pattern = "<{} [^>]*{}=['\"]{}['\"][^>*]>".format(self.milestone_tag, self.identifying_attr, self.identifying_val)
-        else:
-            pattern = "<{} [^>*]>".format(self.milestone_tag)
-        reg = regex.compile(pattern)
-
-        self.parts = reg.split(text)
-
-    @staticmethod
-    def get_parents(milestone):
-        """Get the parent tags of the milestone."""
-        return [(parent.tag, parent.attrib)
-                for parent in milestone.iterancestors()]
-
-    @staticmethod
-    def create_closing_tags(parent):
-        """Create one closing tag string."""
-        closing = ""
-        for tag, _ in parent:
-            closing += CLOSING_TAG % tag
-        return closing
-
-    @staticmethod
-    def create_opening_tags(parent):
-        """Create one opening tag string."""
-        opening = ""
-        for tag, pairs in reversed(parent):
-            attribute_xml = ""
-            for keyvalue in pairs.items():
-                attribute_xml += ATTRIBUTE % keyvalue
-            attribute_xml += ATTRIBUTE % ("continued", "true")
-            opening += OPENING_TAG % (tag, attribute_xml)
-        return opening
-
-
-class Work:
-    def __init__(self, tei):
-        self._books = []
-        self.title = tei.findAll('title')[0].string
-        book_tags = tei.findAll("div", subtype="book")
-        for b in book_tags:
-            book = self.add_book(b)
-
-    def add_book(self, elem):
-        b = Book(elem)
-        self._books += [b]
-        return b
-
-    def array(self):
-        return [b.array() for b in self._books]
-
-
-class Book:
-    def __init__(self, elem):
-        self._sections = []
-        section_tags = elem.findAll("div", subtype="section")
-        for section in section_tags:
-            self.add_section(section)
-
-    def add_section(self, elem):
-        num = int(elem["n"])
-        while len(self._sections) < num:
-            self._sections += [[]]
-
-        s = Section(elem)
-        self._sections[num - 1] = s
-        return s
-
-    def array(self):
-        return [s.array() if s else [] for s in self._sections]
-
-
-class Section:
-    def __init__(self, elem):
-        self._elem = elem
-        self._segments = []
-        self.transform()
-
-    def transform(self):
-        remove_tags = ["said", "p"]
-        for tag in remove_tags:
-            for e in self._elem(tag):
-                e.unwrap()
-
-        for e in self._elem("milestone", unit=["page","section"]):
-            e.unwrap()
-
-        for e in self._elem("q"):
-            e.insert_before(tei.new_string('"'))
-            e.insert_after(tei.new_string('"'))
-            e.unwrap()
-
-        for tag in ["gloss","quote","title","foreign","placeName","bibl"]:
-            for e in self._elem(tag):
-                new_tag = tei.new_tag("i")
-                new_tag["class"] = tag
-                e.wrap(new_tag)
-                e.unwrap()
-
-        for e in self._elem("note"):
-            '''
-            <sup>1</sup><i class="footnote" style="display: none;"></i>
-            '''
-            sup = tei.new_tag("sup")
-            sup.string = "*"
-            e.insert_before(sup)
-
-            new_tag = tei.new_tag("i")
-            new_tag["class"] = "footnote"
-            new_tag["style"] = "display: none"
-            e.wrap(new_tag)
-            e.unwrap()
-
-        for seg in msplitter.split(unicode(self._elem)):
-            s = "".join([unicode(x) for x in BeautifulSoup(seg, "xml").div.contents]).strip()
-            if s:
-                self._segments += [s]
-
-    def array(self):
-        return self._segments
-
-# <milestone ed="P" unit="para"/>
-msplitter = MilestoneSplitter("milestone", "unit", "para")
-
-tei = BeautifulSoup(open("tlg0059.tlg030.perseus-eng2.xml").read(), "xml")
-work = Work(tei)
-
-name = "Republic"
-hname = u"א" + name
-index = Index()
-index.set_title(name)
-index.categories = ["Philosophy", "Classical Philosophy", "Plato"]
-
-root = JaggedArrayNode()
-root.add_primary_titles(name, hname)
-root.add_structure(["Book", "Page", "Paragraph"])
-root.index = index
-
-index.nodes = root
-
-IndexSet({"title": name}).delete()
-
-try:
-    index.save()
-except Exception:
-    pass
-
-
-VersionSet({"title": name}).delete()
-v = Version()
-v.versionTitle = "Perseus"
-v.versionSource = ""
-v.language = "en"
-v.chapter = work.array()
-v.title = name
-v.save()
-
-'''
-To deal with:
-<milestone unit="page" resp="Stephanus" n="329"/>
-<milestone unit="section" resp="Stephanus" n="329a"/>
-<milestone ed="P" unit="para"/>
-<p>
-<q> for quote
-<said> for whom is speaking?  Seems innacurate
-<note>
-<quote>
-<title>
-<gloss>
-<foreign>
-<bibl>
-<placeName>
-'''
-
-# https://en.wikipedia.org/wiki/Stephanus_pagination
-# To begin, we'll just get page numbers. and not column letters.  The latter will need a new address class
-
+from stephanus import COLLECTION as STEPHANUS_COLLECTION, StephanusIndex
+from tei import WORKS, aligned_jobs, parse_job, find_sources
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import model, parse_cache
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_index(meta):
+    name = meta["title"]
+    hname = u"א" + name
+    models = model.load()
+    index = models.Index()
+    index.set_title(name)
+    index.categories = meta["categories"]
+
+    root = models.JaggedArrayNode()
+    root.add_primary_titles(name, hname)
+    root.add_structure(meta["scheme"].section_names)
+    root.index = index
+
+    index.nodes = root
+    return index
+
+
+def make_version(meta, chapter):
+    v = model.load().Version()
+    v.versionTitle = meta["versionTitle"]
+    v.versionSource = meta["versionSource"]
+    v.language = meta["language"]
+    v.chapter = chapter
+    v.title = meta["title"]
+    return v
+
+
+def save_index(meta):
+    index = make_index(meta)
+
+    model.load().IndexSet({"title": meta["title"]}).delete()
+
+    try:
+        index.save()
+    except Exception:
+        pass
+
+
+def save_version(meta, chapter):
+    model.load().VersionSet(version_key(meta)).delete()
+    make_version(meta, chapter).save()
+
+
+def version_key(meta):
+    return {"title": meta["title"], "versionTitle": meta["versionTitle"], "language": meta["language"]}
+
+
+def save_stephanus(meta, index):
+    """Store the Stephanus index of a Version next to it, replacing any from an earlier load"""
+    db = model.database()
+    db[STEPHANUS_COLLECTION].remove(version_key(meta))
+    record = version_key(meta)
+    record.update(index.to_json())
+    db[STEPHANUS_COLLECTION].insert(record)
+
+
+def parse_works(filenames, processes=None, cache=None, aligned=False):
+    """
+    Parse each file in its own worker process.
+    :param aligned: parse the editions of each ALIGNED work together, in one job, and align their units
+    :return: iterator of (filenames, jagged array of each, alignment or None, reference milestones of each),
+        in the order the jobs are done
+    """
+    jobs = aligned_jobs(filenames) if aligned else filenames
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(functools.partial(parse_job, cache=cache), jobs):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def alignment_record(filenames, alignment):
+    """Alignment of a work's editions, as json-able data, with a description of the editions"""
+    metas = [WORKS[os.path.basename(f)] for f in filenames]
+    return {
+        "title": metas[0]["title"],
+        "sectionNames": metas[0]["scheme"].section_names,
+        "editions": [{"versionTitle": m["versionTitle"], "language": m["language"]} for m in metas],
+        # [address, references of the first edition at that address, of the second, ...]
+        "alignment": alignment,
+    }
+
+
+def describe_alignment(record):
+    complete = sum(1 for entry in record["alignment"] if all(len(refs) == 1 for refs in entry[1:]))
+    return "Aligned {}: {} addresses, {} with one unit of every edition".format(
+        record["title"], len(record["alignment"]), complete)
+
+
+def load_works(filenames, processes=None, cache=None, bulk=None, aligned=False, alignments=None):
+    """
+    Parse each file in its own worker process, and write the results from this process as they arrive.
+    Each Index is created once, before its first Version.  Versions with Stephanus references have their
+    StephanusIndex stored with them.
+    :param bulk: BulkLoader.  If given, records are collected and written together once every file is parsed.
+    :param aligned: parse the editions of each ALIGNED work together, and align their units
+    :param alignments: list to add the alignment_record() of each aligned work to
+    """
+    saved_indexes = set()
+    for done, chapters, alignment, references in parse_works(filenames, processes, cache, aligned):
+        for filename, chapter, markers in zip(done, chapters, references):
+            meta = WORKS[os.path.basename(filename)]
+            print "Parsed {} ({})".format(meta["title"], filename)
+            if bulk:
+                if meta["title"] not in saved_indexes:
+                    bulk.add_index(make_index(meta))
+                bulk.add_version(make_version(meta, chapter))
+            else:
+                if meta["title"] not in saved_indexes:
+                    save_index(meta)
+                save_version(meta, chapter)
+            if markers is not None:
+                save_stephanus(meta, StephanusIndex.from_markers(markers))
+            saved_indexes.add(meta["title"])
+        if alignment is not None:
+            record = alignment_record(done, alignment)
+            print describe_alignment(record)
+            if alignments is not None:
+                alignments += [record]
+
+    if bulk:
+        bulk.flush()
+
+
+def dump_works(filenames, out, processes=None, cache=None, aligned=False):
+    """
+    Write each file's Version to out as a line of json, instead of to the database.
+    Versions with Stephanus references include their StephanusIndex, as "stephanus".
+    With aligned, each aligned work's alignment_record() follows its Versions.
+    """
+    for done, chapters, alignment, references in parse_works(filenames, processes, cache, aligned):
+        for filename, chapter, markers in zip(done, chapters, references):
+            meta = WORKS[os.path.basename(filename)]
+            record = {
+                "title": meta["title"],
+                "versionTitle": meta["versionTitle"],
+                "language": meta["language"],
+                "sectionNames": meta["scheme"].section_names,
+                "chapter": chapter,
+            }
+            if markers is not None:
+                record["stephanus"] = StephanusIndex.from_markers(markers).to_json()
+            out.write(json.dumps(record) + "\n")
+        if alignment is not None:
+            out.write(json.dumps(alignment_record(done, alignment)) + "\n")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sources", nargs="*", default=[os.path.join(DIRECTORY, "tlg0059.tlg030.perseus-eng2.xml")],
+                        help="TEI files, directories or glob patterns to load")
+    parser.add_argument("-p", "--processes", type=int, default=None,
+                        help="Number of parser processes.  Defaults to the number of CPUs")
+    parser.add_argument("--no-cache", action="store_true", help="Always parse, and don't store results in the cache")
+    parser.add_argument("--cache-dir", default=parse_cache.DEFAULT_DIRECTORY, help="Parse cache directory")
+    parser.add_argument("--cache-max-mb", type=int, default=parse_cache.DEFAULT_MAX_BYTES / (1024 * 1024),
+                        help="Size cap for the parse cache, in MB")
+    parser.add_argument("--bulk", action="store_true",
+                        help="Write all records in bulk at the end of the run, and update counts and the toc once")
+    parser.add_argument("--dry-run", metavar="FILE",
+                        help="Parse only, and write each Version to FILE as a line of json, or to stdout for '-'. "
+                             "Nothing is written to the database.")
+    parser.add_argument("--aligned", action="store_true",
+                        help="Parse the editions of each work in ALIGNED together, when all of them are loaded, "
+                             "and record which unit of each edition is at each address")
+    parser.add_argument("--alignment", metavar="FILE", help="With --aligned, write the alignments to FILE as json")
+    args = parser.parse_args()
+
+    cache = None if args.no_cache else parse_cache.ParseCache(args.cache_dir, args.cache_max_mb * 1024 * 1024)
+    filenames = find_sources(args.sources)
+    if not filenames:
+        sys.exit("No TEI files to load")
+    if args.dry_run == "-":
+        dump_works(filenames, sys.stdout, args.processes, cache, args.aligned)
+    elif args.dry_run:
+        with open(args.dry_run, "w") as f:
+            dump_works(filenames, f, args.processes, cache, args.aligned)
+    else:
+        bulk_loader = None
+        if args.bulk:
+            from common.bulk import BulkLoader
+            bulk_loader = BulkLoader()
+        alignments = []
+        load_works(filenames, args.processes, cache, bulk_loader, args.aligned, alignments)
+        if args.alignment:
+            with open(args.alignment, "w") as f:
+                json.dump(alignments, f)
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Index from Stephanus references to the place in a Version where they begin.
+https://en.wikipedia.org/wiki/Stephanus_pagination
+
+The Republic is cited in the jagged array by Book, Page and Paragraph, and by Stephanus page and column
+with milestones in the text, e.g. <milestone unit="section" resp="Stephanus" n="329a"/>.
+The parser records the address of each of those milestones.  This keeps them sorted, so that a reference,
+or a range like 327a-331d, is found with a binary search.
+
+    python stephanus.py index.json 329a 327a-331d
+    python stephanus.py --check tlg0059.tlg030.perseus-eng2.xml
+"""
+import argparse
+import bisect
+import json
+import os
+import sys
+
+from lxml import etree
+import regex
+
+from tei import NAMESPACES, WORKS
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import model
+
+# Stored next to the Version, one record per version
+COLLECTION = "stephanus_index"
+
+# Page, and optionally the column, a to e
+REFERENCE = regex.compile(r"^\s*(\d+)\s*([a-eA-E]?)\s*$")
+# Markup, and the footnote marks and quotation marks that transform() adds
+ADDED = regex.compile(r'<sup>\*</sup>|<[^>]*>|"')
+WHITESPACE = regex.compile(r"\s+", regex.U)
+TEI_DIV = "{%s}div" % NAMESPACES["tei"]
+TEI_MILESTONE = "{%s}milestone" % NAMESPACES["tei"]
+TEI_REG = "{%s}reg" % NAMESPACES["tei"]
+# Words of the text after a milestone to look for in its paragraph, up to the end of the paragraph.
+# Enough that they aren't also found in the paragraph before.
+CHECK_WORDS = 12
+
+
+def parse_reference(ref):
+    """
+    :return: sort key of a Stephanus reference, e.g. (329, "a") for 329a.  A page on its own, (329, ""),
+        sorts before its columns.
+    """
+    match = REFERENCE.match(ref)
+    if not match:
+        raise ValueError(u"Not a Stephanus reference: {}".format(ref))
+    return int(match.group(1)), match.group(2).lower()
+
+
+class StephanusIndex(object):
+    """
+    Sorted Stephanus references, and the address of each in the jagged array:
+    (book, page, paragraph), counted from 0, as the alignment map has them.
+    """
+    def __init__(self, refs, addresses):
+        """:param refs, addresses: in the order of their references, as to_json() writes them"""
+        self.refs = refs
+        self.addresses = [tuple(a) for a in addresses]
+        self._keys = [parse_reference(r) for r in refs]
+
+    @classmethod
+    def from_markers(cls, markers):
+        """
+        :param markers: [reference, address] for each milestone, in document order, as the parser records them.
+            Where a reference is marked more than once, the first is kept.
+        """
+        entries = {}
+        for ref, address in markers:
+            key = parse_reference(ref)
+            if key not in entries:
+                entries[key] = (ref, address)
+        keys = sorted(entries)
+        return cls([entries[k][0] for k in keys], [entries[k][1] for k in keys])
+
+    def _position(self, ref):
+        """Position of the last marker at or before ref"""
+        i = bisect.bisect_right(self._keys, parse_reference(ref)) - 1
+        if i < 0:
+            raise KeyError(u"{} comes before the first Stephanus reference, {}".format(ref, self.refs[0]))
+        return i
+
+    def lookup(self, ref):
+        """
+        :return: address of the paragraph where ref begins.  A reference that isn't marked itself,
+            like a column within a page, is found at the last marker before it.
+        """
+        return self.addresses[self._position(ref)]
+
+    def range(self, refs):
+        """
+        :param refs: a reference, or a range, e.g. 327a-331d
+        :return: (address where the first begins, address where the last begins)
+        """
+        first, _, last = refs.partition(u"-")
+        start, end = self._position(first), self._position(last or first)
+        if end < start:
+            raise ValueError(u"{} comes after {}".format(first, last))
+        return self.addresses[start], self.addresses[end]
+
+    def between(self, refs):
+        """:return: the marked references from the one that contains the first of refs to the last, in order"""
+        first, _, last = refs.partition(u"-")
+        return self.refs[self._position(first):self._position(last or first) + 1]
+
+    def to_json(self):
+        return {"refs": self.refs, "addresses": [list(a) for a in self.addresses]}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["refs"], data["addresses"])
+
+    @classmethod
+    def load(cls, title, versionTitle, language):
+        """:return: the index stored with a Version, or None"""
+        record = model.database()[COLLECTION].find_one(
+            {"title": title, "versionTitle": versionTitle, "language": language})
+        return cls.from_json(record) if record else None
+
+    def __len__(self):
+        return len(self.refs)
+
+
+def _plain(html):
+    text = ADDED.sub(u" ", html).replace(u"&lt;", u"<").replace(u"&gt;", u">").replace(u"&amp;", u"&")
+    return WHITESPACE.sub(u" ", text).strip()
+
+
+def following_words(filename, resp):
+    """
+    :return: list of (n, the first words of the text after it, to the end of its paragraph)
+        for each page and section milestone of resp, in document order.
+        Regularized forms, which the parser drops, are left out.
+    """
+    milestones = []
+    collecting = []  # [n, words] of milestones with too few words so far
+    reg = 0
+
+    def add(text):
+        if text and collecting and not reg:
+            words = text.replace(u'"', u" ").split()
+            for m in collecting:
+                m[1] += words
+            collecting[:] = [m for m in collecting if len(m[1]) < CHECK_WORDS]
+
+    for event, e in etree.iterwalk(etree.parse(filename), events=("start", "end")):
+        if not isinstance(e.tag, basestring):
+            if event == "end":
+                add(e.tail)
+            continue
+        if e.tag == TEI_DIV or e.tag == TEI_MILESTONE and e.get("unit") == "para":
+            # The paragraph ends.  Milestones with no text after them yet go with the next one.
+            collecting[:] = [m for m in collecting if not m[1]]
+        if event == "start":
+            if e.tag == TEI_REG:
+                reg += 1
+            elif e.tag == TEI_MILESTONE and e.get("resp") == resp and e.get("unit") in ["page", "section"] \
+                    and e.get("n"):
+                milestones += [[e.get("n"), []]]
+                collecting += [milestones[-1]]
+            add(e.text)
+        else:
+            if e.tag == TEI_REG:
+                reg -= 1
+            add(e.tail)
+    return [(n, u" ".join(words[:CHECK_WORDS])) for n, words in milestones]
+
+
+def check(filename):
+    """
+    Parse filename, and check that the paragraph at the address of each Stephanus milestone
+    holds the text that follows the milestone in the source.
+    :return: list of (reference, address, the words that weren't found there)
+    """
+    scheme = WORKS[os.path.basename(filename)]["scheme"]
+    chapter, markers = scheme.extract(filename)
+    addresses = {}
+    for ref, address in markers:
+        addresses.setdefault(ref, address)
+
+    problems = []
+    for ref, words in following_words(filename, scheme.references):
+        if ref not in addresses:
+            continue
+        address = addresses.pop(ref)
+        paragraph = chapter
+        for i in address:
+            paragraph = paragraph[i]
+        if words not in _plain(paragraph):
+            problems += [(ref, address, words)]
+    return problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("index", help="json file with an index, e.g. a Version line of parse_tei_plato.py --dry-run")
+    parser.add_argument("refs", nargs="*", help="Stephanus references or ranges, e.g. 329a or 327a-331d")
+    parser.add_argument("--check", action="store_true",
+                        help="index is a TEI file instead.  Parse it, and check the address of every milestone.")
+    args = parser.parse_args()
+
+    if args.check:
+        problems = check(args.index)
+        for ref, address, words in problems:
+            print u"{} at {}: no \"{}\"".format(ref, list(address), words).encode("utf-8")
+        print "{} problems".format(len(problems))
+        sys.exit(1 if problems else 0)
+    with open(args.index) as f:
+        data = json.loads(f.readline())
+    index = StephanusIndex.from_json(data.get("stephanus", data))
+    for refs in args.refs:
+        start, end = index.range(refs)
+        print u"{}: {} - {}".format(refs, u":".join(str(i + 1) for i in start), u":".join(str(i + 1) for i in end))
@@ -0,0 +1,642 @@
+# -*- coding: utf-8 -*-
+"""
+Parsing of the Perseus TEI editions into jagged arrays.
+
+Nothing here needs Django or the Sefaria model, so it can be imported by worker processes and dry runs
+without setting either up.  parse_tei_plato.py writes the results to the database.
+"""
+import functools
+import glob
+import os
+import sys
+from itertools import izip_longest
+from lxml import etree
+import regex
+
+# Bump when a change to the parser or to a citation scheme changes the output, to invalidate cached results
+PARSER_VERSION = 3
+
+CLOSING_TAG = "</%s>"
+OPENING_TAG = '<%s%s>'
+ATTRIBUTE = ' %s="%s"'
+XML_NS = "{http://www.w3.org/XML/1998/namespace}"
+NAMESPACES = {"tei": "http://www.tei-c.org/ns/1.0"}
+TEI_DIV = "{http://www.tei-c.org/ns/1.0}div"
+LEADING_INT = regex.compile(r"\s*(\d+)")
+# BeautifulSoup collapses text nodes made up only of these characters to a single space or newline
+ASCII_SPACES = u"\x20\x0a\x09\x0c\x0d"
+WHITESPACE_RUN = regex.compile(u">([{0}]+)<".format(ASCII_SPACES))
+SPLIT_FRAGMENTS = {}
+
+
+class MilestoneSplitter(object):
+    """Split sections at milestone tag."""
+
+    def __init__(self,
+                 milestone_tag,
+                 identifying_attr = None,
+                 identifying_val = None,
+                 ):
+        self.milestone_tag = milestone_tag
+        self.identifying_attr = identifying_attr
+        self.identifying_val = identifying_val
+
+    def split_element(self, elem):
+        """
+        Split the contents of an lxml element, without serializing and reparsing it.
+        Returns segments as lists of string fragments, one more than the milestones in elem.
+        """
+        segments = serialize(elem, self.is_milestone)
+        count = sum(1 for e in elem.iter(self.milestone_tag) if self.is_milestone(e))
+        if len(segments) != count + 1:
+            raise ValueError("Split the section into {} parts, but found {} milestones in the tree".format(
+                len(segments), count))
+        return segments
+
+    def is_milestone(self, elem):
+        return elem.tag == self.milestone_tag and (
+            not self.identifying_attr or elem.get(self.identifying_attr) == self.identifying_val)
+
+
+def _localname(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def _collapse_whitespace(text):
+    if text and not text.strip(ASCII_SPACES):
+        return u"\n" if u"\n" in text else u" "
+    return text
+
+
+def _escape_text(text):
+    return text.replace(u"&", u"&amp;").replace(u"<", u"&lt;").replace(u">", u"&gt;")
+
+
+def _quote_attr(value):
+    """Quote an attribute value the way BeautifulSoup's xml formatter does."""
+    value = _escape_text(value)
+    if u'"' in value:
+        if u"'" in value:
+            return u'"%s"' % value.replace(u'"', u"&quot;")
+        return u"'%s'" % value
+    return u'"%s"' % value
+
+
+def _attribute_xml(attrib, continued=False):
+    attribute_xml = u""
+    for key, value in attrib.items():
+        if key.startswith(XML_NS):
+            key = u"xml:" + key[len(XML_NS):]
+        attribute_xml += u" %s=%s" % (key, _quote_attr(value))
+    if continued:
+        attribute_xml += ATTRIBUTE % ("continued", "true")
+    return attribute_xml
+
+
+def _unwrap(elem, before=u"", after=u""):
+    """Replace elem with its contents, optionally surrounded by two strings.  Keeps elem.tail."""
+    parent = elem.getparent()
+    leading = before + (elem.text or u"")
+    trailing = after + (elem.tail or u"")
+    children = list(elem)
+
+    # Found from elem rather than by position, which would mean a scan of parent's children
+    previous = elem.getprevious()
+    if previous is not None:
+        previous.tail = (previous.tail or u"") + leading
+    else:
+        parent.text = (parent.text or u"") + leading
+
+    for child in children:
+        elem.addprevious(child)
+    parent.remove(elem)
+
+    if children:
+        children[-1].tail = (children[-1].tail or u"") + trailing
+    elif previous is not None:
+        previous.tail = (previous.tail or u"") + trailing
+    else:
+        parent.text = (parent.text or u"") + trailing
+
+
+def _rename(elem, tag, attrib):
+    elem.attrib.clear()
+    elem.tag = tag
+    for key, value in attrib:
+        elem.set(key, value)
+
+
+def _leading_int(value):
+    match = LEADING_INT.match(value or u"")
+    return int(match.group(1)) if match else None
+
+
+def _drop(elem):
+    # Regularized place names, with coordinates, are not part of the text
+    elem.text = None
+    del elem[:]
+    _unwrap(elem)
+
+
+def _unwrap_milestone(elem):
+    if elem.get("unit") in ["page", "section"]:
+        _unwrap(elem)
+
+
+def _italic(elem):
+    _rename(elem, "i", [("class", elem.tag)])
+
+
+def _footnote(elem):
+    sup = etree.Element("sup")
+    sup.text = u"*"
+    elem.addprevious(sup)
+    _rename(elem, "i", [("class", "footnote"), ("style", "display: none")])
+
+
+# What transform() does with each TEI tag.  Other tags are kept as they are.
+REWRITES = {
+    "said": _unwrap,
+    "p": _unwrap,
+    "milestone": _unwrap_milestone,
+    "reg": _drop,
+    "q": functools.partial(_unwrap, before=u'"', after=u'"'),
+    "gloss": _italic,
+    "quote": _italic,
+    "title": _italic,
+    "foreign": _italic,
+    "placeName": _italic,
+    "bibl": _italic,
+    "note": _footnote,
+}
+
+
+def transform(elem):
+    """
+    Rewrite the TEI markup inside one citable unit into the html that the reader displays.
+    Works in place, on lxml elements, in one walk of the tree.
+    Each element is rewritten after its children, so that the text an unwrap moves has already been normalized,
+    and elements that an unwrap moves up have already been rewritten.
+    """
+    elem.text = _collapse_whitespace(elem.text)
+    stack = [iter(list(elem))]
+    parents = []  # for each iterator on the stack but the first, the element whose children it walks
+    while stack:
+        for e in stack[-1]:
+            # Only whitespace changes, and most text isn't whitespace, so most nodes are read but not written
+            text, tail = e.text, e.tail
+            if text and not text.strip(ASCII_SPACES):
+                e.text = _collapse_whitespace(text)
+            if tail and not tail.strip(ASCII_SPACES):
+                e.tail = _collapse_whitespace(tail)
+            if not isinstance(e.tag, basestring):
+                continue
+            e.tag = _localname(e.tag)
+            if len(e):
+                stack.append(iter(list(e)))
+                parents.append(e)
+                break
+            rewrite = REWRITES.get(e.tag)
+            if rewrite:
+                rewrite(e)
+        else:
+            stack.pop()
+            if parents:
+                e = parents.pop()
+                rewrite = REWRITES.get(e.tag)
+                if rewrite:
+                    rewrite(e)
+
+
+def _split_fragments(tag, attribute_xml):
+    """(opening tag with continued="true", closing tag), built once and shared by every element with this markup"""
+    key = (tag, attribute_xml)
+    try:
+        return SPLIT_FRAGMENTS[key]
+    except KeyError:
+        fragments = SPLIT_FRAGMENTS[key] = (
+            OPENING_TAG % (tag, attribute_xml + ATTRIBUTE % ("continued", "true")), CLOSING_TAG % tag)
+        return fragments
+
+
+def serialize(section, is_milestone=None):
+    """
+    Serialize the contents of section, starting a new segment at every element for which is_milestone() is true.
+    Elements that are open at a break are closed before it and reopened, with continued="true", after it.
+    Other milestones are dropped.
+    :return: list of segments, each a list of string fragments
+    """
+    segments = [[]]
+    open_tags = []  # (reopening tag, closing tag) of each open element, outermost first
+
+    def write(e):
+        current = segments[-1]
+        if not isinstance(e.tag, basestring):
+            current += [etree.tostring(e, encoding=unicode, with_tail=False)]
+        elif is_milestone and is_milestone(e):
+            current += [u"\n"] + [close for _, close in reversed(open_tags)]
+            segments.append([reopen for reopen, _ in open_tags] + [u"\n"])
+        elif e.tag == "milestone":
+            pass
+        elif not e.text and len(e) == 0:
+            current += [u"<%s%s/>" % (e.tag, _attribute_xml(e.attrib))]
+        else:
+            attribute_xml = _attribute_xml(e.attrib)
+            current += [OPENING_TAG % (e.tag, attribute_xml)]
+            open_tags.append(_split_fragments(e.tag, attribute_xml))
+            if e.text:
+                current += [_escape_text(e.text)]
+            for child in e:
+                write(child)
+            segments[-1] += [open_tags.pop()[1]]
+        if e.tail:
+            segments[-1] += [_escape_text(e.tail)]
+
+    if section.text:
+        segments[-1] += [_escape_text(section.text)]
+    for child in section:
+        write(child)
+    return segments
+
+
+def _clean(segment):
+    # Segments used to be reparsed by BeautifulSoup, which collapses whitespace between tags
+    return WHITESPACE_RUN.sub(lambda m: u">%s<" % _collapse_whitespace(m.group(1)), u"".join(segment)).strip()
+
+
+class CitationLevel(object):
+    """
+    One level of a citation scheme - the equivalent of a CTS citation / cRefPattern.
+    :param name: Sefaria section name for this level
+    :param match: XPath, evaluated on a <div>, that is true when the div is a unit of this level
+    :param numbered: If True, units are placed by the leading number of their @n.  Otherwise by document order.
+    """
+    def __init__(self, name, match, numbered=True):
+        self.name = name
+        self.match = etree.XPath(match, namespaces=NAMESPACES)
+        self.numbered = numbered
+
+    def address(self, elem, container, offset):
+        """
+        Index of elem within container.
+        offset is the length container had when it was opened, so that continuations, like chapters 121A and 121B,
+        are numbered after what is already there.  Units without a number, like a preface, go in the first place.
+        """
+        if not self.numbered:
+            return len(container)
+        return offset + (_leading_int(elem.get("n")) or 1) - 1
+
+
+class CitationScheme(object):
+    """
+    How one TEI edition is cited: the nested divs of each level, outermost first,
+    and optionally a MilestoneSplitter that breaks the innermost unit into segments.
+    :param references: @resp of page and section milestones, like Stephanus', whose addresses are recorded
+    """
+    def __init__(self, levels, splitter=None, split_name=None, references=None):
+        self.levels = levels
+        self.splitter = splitter
+        self.split_name = split_name
+        self.references = references
+
+    @property
+    def section_names(self):
+        return [l.name for l in self.levels] + ([self.split_name] if self.splitter else [])
+
+    def leaf(self, elem, markers=()):
+        """
+        Content of one innermost unit.  A list of segments if the scheme splits, otherwise a string.
+        :param markers: [reference, segment] from reference_markers().  Segments are renumbered in place,
+            to count only the segments that are kept.
+        """
+        transform(elem)
+        if not self.splitter:
+            return _clean(serialize(elem)[0])
+        segments = [_clean(seg) for seg in self.splitter.split_element(elem)]
+        kept = [s for s in segments if s]
+        if markers:
+            # A marker in a segment that is dropped goes with the next segment that is kept
+            positions = []
+            count = 0
+            for s in segments:
+                positions += [count]
+                count += bool(s)
+            for marker in markers:
+                marker[1] = max(0, min(positions[marker[1]], len(kept) - 1))
+        return kept
+
+    def reference_markers(self, elem):
+        """
+        The page and section milestones of self.references in one innermost unit, before transform() drops them.
+        A milestone belongs to the segment where the text after it begins, which is a later one
+        when there is only whitespace between it and the splitter's milestone.
+        :return: list of [n, index of the segment]
+        """
+        markers = []
+        pending = []  # markers with no text after them yet
+        segment = 0
+        for event, e in etree.iterwalk(elem, events=("start", "end")):
+            if e is elem:
+                text = e.text if event == "start" else None
+            elif not isinstance(e.tag, basestring):
+                text = e.tail
+            elif event == "end":
+                text = e.tail
+            else:
+                text = e.text
+                tag = _localname(e.tag)
+                if self.splitter and tag == self.splitter.milestone_tag and (
+                        not self.splitter.identifying_attr
+                        or e.get(self.splitter.identifying_attr) == self.splitter.identifying_val):
+                    segment += 1
+                    for marker in pending:
+                        marker[1] = segment
+                elif tag == "milestone" and e.get("resp") == self.references \
+                        and e.get("unit") in ["page", "section"] and e.get("n"):
+                    markers += [[e.get("n"), segment]]
+                    pending += [markers[-1]]
+            if text and text.strip():
+                pending = []
+        return markers
+
+    def extract(self, filename):
+        """
+        Walk filename once, with iterparse, and return its jagged array.
+        Each innermost unit is dropped from the tree as soon as it is read, so memory is bounded by one unit.
+        :return: (jagged array, [reference, address] of each reference milestone, or None if the scheme has none)
+        """
+        result = []
+        references = [] if self.references else None
+        for _ in self.walk(filename, result, references):
+            pass
+        return result, references
+
+    def extract_aligned(self, filenames):
+        """
+        Walk several editions that are cited by this scheme in lockstep, a unit from each in turn,
+        and record which unit of each edition lands at each address.
+        :return: (list of jagged arrays, one per file,
+            alignment: list of [address, references from the first file, references from the second file, ...]
+            in address order.  An edition with nothing at an address has an empty list there,
+            list of the reference milestones of each file, as extract())
+        """
+        results = [[] for _ in filenames]
+        references = [[] if self.references else None for _ in filenames]
+        alignment = {}
+        walks = [self.walk(f, r, m) for f, r, m in zip(filenames, results, references)]
+        for units in izip_longest(*walks):
+            for i, unit in enumerate(units):
+                if unit is None:
+                    continue
+                address, reference = unit
+                if address not in alignment:
+                    alignment[address] = [[] for _ in filenames]
+                alignment[address][i] += [reference]
+        alignment = [[list(address)] + refs for address, refs in sorted(alignment.iteritems())]
+        return results, alignment, references
+
+    def walk(self, filename, result, references=None):
+        """
+        Fill result with the jagged array of filename.
+        Yields (address, reference) for each innermost unit as it is placed, e.g. ((0, 0, 0), "1.1.pr"),
+        where address is the unit's position in result and reference is its citation in the edition.
+        :param references: list to add [n, address] to for each reference milestone, e.g. ["328c", [0, 327, 2]].
+            With a splitter, the address is of the segment the milestone is in.
+        """
+        blank = [] if self.splitter else u""
+        last = len(self.levels) - 1
+        stack = []  # (element, level, container, offset, address of container) for each open unit
+
+        for event, elem in etree.iterparse(filename, events=("start", "end"), tag=TEI_DIV):
+            if event == "start":
+                depth = len(stack)
+                if depth <= last and self.levels[depth].match(elem):
+                    level = self.levels[depth]
+                    container, offset, address = (stack[-1][2], stack[-1][3], stack[-1][4]) if stack else (result, 0, ())
+                    if depth < last:
+                        num = level.address(elem, container, offset)
+                        while len(container) <= num:
+                            container += [[]]
+                        stack.append((elem, level, container[num], len(container[num]), address + (num,)))
+                    else:
+                        stack.append((elem, level, container, offset, address))
+                continue
+
+            if not stack or stack[-1][0] is not elem:
+                continue
+            _, level, container, offset, address = stack.pop()
+            if len(stack) < last:
+                continue
+
+            num = level.address(elem, container, offset)
+            while len(container) <= num:
+                container += [blank]
+            markers = self.reference_markers(elem) if references is not None else ()
+            value = self.leaf(elem, markers)
+            before = 0
+            if not container[num]:
+                container[num] = value
+            elif self.splitter:
+                before = len(container[num])
+                container[num] = container[num] + value
+            else:
+                container[num] += u" " + value
+            for n, segment in markers:
+                references += [[n, list(address + (num,)) + ([before + segment] if self.splitter else [])]]
+            reference = u".".join([unit[0].get("n") or u"" for unit in stack] + [elem.get("n") or u""])
+
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+            yield address + (num,), reference
+
+
+# <milestone ed="P" unit="para"/>
+msplitter = MilestoneSplitter("milestone", "unit", "para")
+
+
+def textpart(*subtypes):
+    return "self::tei:div[{}]".format(" or ".join("@subtype='{}'".format(s) for s in subtypes))
+
+
+# Citation schemes, one for each way the bundled editions are divided
+STEPHANUS_PAGES = CitationScheme([
+    CitationLevel("Book", textpart("book")),
+    CitationLevel("Page", textpart("section")),
+], splitter=msplitter, split_name="Paragraph", references="Stephanus")
+
+BOOK_CARD = CitationScheme([
+    CitationLevel("Book", textpart("book")),
+    CitationLevel("Paragraph", textpart("card"), numbered=False),
+])
+
+BOOK_CHAPTER_SECTION = CitationScheme([
+    CitationLevel("Book", textpart("book", "Book")),
+    CitationLevel("Chapter", textpart("chapter")),
+    CitationLevel("Section", textpart("section")),
+])
+
+# Records to create for each source file, keyed by file name.
+# Sefaria versions are either "en" or "he"; original language editions go in the "he" slot.
+WORKS = {
+    "tlg0059.tlg030.perseus-eng2.xml": {
+        "title": "Republic",
+        "categories": ["Philosophy", "Classical Philosophy", "Plato"],
+        "scheme": STEPHANUS_PAGES,
+        "versionTitle": "Perseus",
+        "versionSource": "",
+        "language": "en",
+    },
+    "tlg0012.tlg001.perseus-eng3.xml": {
+        "title": "Iliad",
+        "categories": ["Poetry", "Homer"],
+        "scheme": BOOK_CARD,
+        "versionTitle": "Perseus: A. T. Murray, 1924",
+        "versionSource": "http://www.perseus.tufts.edu/hopper/text?doc=Perseus:text:1999.01.0134",
+        "language": "en",
+    },
+    "tlg0012.tlg001.perseus-eng4.xml": {
+        "title": "Iliad",
+        "categories": ["Poetry", "Homer"],
+        "scheme": BOOK_CARD,
+        "versionTitle": "Perseus: Samuel Butler, 1898",
+        "versionSource": "http://www.perseus.tufts.edu/hopper/text?doc=Perseus:text:1999.01.0217",
+        "language": "en",
+    },
+    "tlg0012.tlg002.perseus-eng3.xml": {
+        "title": "Odyssey",
+        "categories": ["Poetry", "Homer"],
+        "scheme": BOOK_CARD,
+        "versionTitle": "Perseus: A. T. Murray, 1919",
+        "versionSource": "http://www.perseus.tufts.edu/hopper/text?doc=Perseus:text:1999.01.0136",
+        "language": "en",
+    },
+    "tlg0012.tlg002.perseus-eng4.xml": {
+        "title": "Odyssey",
+        "categories": ["Poetry", "Homer"],
+        "scheme": BOOK_CARD,
+        "versionTitle": "Perseus: Samuel Butler, 1900",
+        "versionSource": "http://www.perseus.tufts.edu/hopper/text?doc=Perseus:text:1999.01.0218",
+        "language": "en",
+    },
+    "tlg0016.tlg001.perseus-eng2.xml": {
+        "title": "Histories",
+        "categories": ["Non Fiction", "History"],
+        "scheme": BOOK_CHAPTER_SECTION,
+        "versionTitle": "Perseus: A. D. Godley, 1920",
+        "versionSource": "http://www.perseus.tufts.edu/hopper/text?doc=Perseus:text:1999.01.0126",
+        "language": "en",
+    },
+    "tlg0016.tlg001.perseus-grc2.xml": {
+        "title": "Histories",
+        "categories": ["Non Fiction", "History"],
+        "scheme": BOOK_CHAPTER_SECTION,
+        "versionTitle": "Perseus: Greek, ed. A. D. Godley, 1920",
+        "versionSource": "http://www.perseus.tufts.edu/hopper/text?doc=Perseus:text:1999.01.0125",
+        "language": "he",
+    },
+}
+
+# Editions of one work that can be parsed together, in lockstep, with an alignment of their units.
+# Each group shares a title and a citation scheme.
+ALIGNED = [
+    ("tlg0016.tlg001.perseus-eng2.xml", "tlg0016.tlg001.perseus-grc2.xml"),
+]
+
+
+def parse_work(filename, cache=None):
+    """
+    Parse one TEI file.  Runs in a worker process, so it only returns plain data.
+    :param cache: ParseCache to read the result from, or store it in
+    :return: (filename, jagged array, reference milestones or None), as CitationScheme.extract()
+    """
+    scheme = WORKS[os.path.basename(filename)]["scheme"]
+    if cache is None:
+        return (filename,) + scheme.extract(filename)
+    key = cache.key(filename, PARSER_VERSION, *scheme.section_names)
+    return (filename,) + tuple(cache.cached(key, scheme.extract, filename))
+
+
+def parse_aligned(filenames, cache=None):
+    """
+    Parse editions of one work together.  Runs in a worker process, so it only returns plain data.
+    :return: (filenames, jagged array of each, alignment, reference milestones of each),
+        as CitationScheme.extract_aligned()
+    """
+    scheme = WORKS[os.path.basename(filenames[0])]["scheme"]
+    if cache is None:
+        return (filenames,) + scheme.extract_aligned(filenames)
+    # Keyed by the contents of every edition
+    others = [cache.key(f, PARSER_VERSION) for f in filenames[1:]]
+    key = cache.key(filenames[0], PARSER_VERSION, "aligned", *(others + scheme.section_names))
+    return (filenames,) + tuple(cache.cached(key, scheme.extract_aligned, filenames))
+
+
+def parse_job(job, cache=None):
+    """
+    :param job: filename, or tuple of filenames to parse together, from aligned_jobs()
+    :return: (filenames, jagged array of each, alignment, or None for a single file, reference milestones of each)
+    """
+    if isinstance(job, tuple):
+        return parse_aligned(job, cache)
+    filename, chapter, references = parse_work(job, cache)
+    return (filename,), [chapter], None, [references]
+
+
+def aligned_jobs(filenames):
+    """
+    Group filenames into jobs, putting the editions of each ALIGNED work together when all of them are given.
+    :return: list of filenames and tuples of filenames
+    """
+    by_name = {os.path.basename(f): f for f in filenames}
+    grouped = {}
+    for names in ALIGNED:
+        if all(name in by_name for name in names):
+            job = tuple(by_name[name] for name in names)
+            for name in names:
+                grouped[by_name[name]] = job
+    jobs = []
+    for filename in filenames:
+        job = grouped.get(filename, filename)
+        if job not in jobs:
+            jobs += [job]
+    return jobs
+
+
+def find_sources(sources):
+    """
+    Expand directories and glob patterns into the list of known TEI files.
+    Sources that match no file are reported on stderr.
+    """
+    filenames = []
+    for source in sources:
+        if os.path.isdir(source):
+            source = os.path.join(source, "*.xml")
+        matches = sorted(glob.glob(source))
+        if not matches:
+            print >> sys.stderr, "No files match {}".format(source)
+        for filename in matches:
+            if os.path.basename(filename) not in WORKS:
+                print >> sys.stderr, "Skipping {}: no entry in WORKS".format(filename)
+            elif filename not in filenames:
+                filenames += [filename]
+    return filenames
+
+'''
+To deal with:
+<milestone ed="P" unit="para"/>
+<p>
+<q> for quote
+<said> for whom is speaking?  Seems innacurate
+<note>
+<quote>
+<title>
+<gloss>
+<foreign>
+<bibl>
+<placeName>
+'''
+
+# https://en.wikipedia.org/wiki/Stephanus_pagination
+# Pages are the Page level.  Columns, <milestone unit="section" resp="Stephanus" n="329a"/>, are recorded with
+# the page milestones by CitationScheme.reference_markers(), and looked up in stephanus.py
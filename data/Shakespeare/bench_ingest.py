@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Time and memory of the two Shakespeare parsers on the same source,
+parse_plays() with a Line object per row, and parse_plays_columnar().
+Each run is in a fresh process, so that peak memory of one doesn't hide the other's.
+
+    python bench_ingest.py [-n REPEAT] [source]
+"""
+import argparse
+import multiprocessing
+import resource
+import time
+
+from shakespeare import parse_plays, parse_plays_columnar
+
+PARSERS = [("objects", parse_plays), ("columnar", parse_plays_columnar)]
+
+
+def measure(name, filename):
+    """Run one parser, and return its time in seconds, growth of peak RSS in MB, and output."""
+    parse = dict(PARSERS)[name]
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    plays = parse(filename)
+    elapsed = time.time() - start
+    growth = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) / 1024.0
+    return elapsed, growth, plays
+
+
+def bench(filename, repeat):
+    outputs = {}
+    for name, _ in PARSERS:
+        times = []
+        growths = []
+        for _ in range(repeat):
+            pool = multiprocessing.Pool(1)
+            try:
+                elapsed, growth, outputs[name] = pool.apply(measure, (name, filename))
+            finally:
+                pool.close()
+                pool.join()
+            times += [elapsed]
+            growths += [growth]
+        print "{:10} {:8.3f} s  {:8.1f} MB peak".format(name, min(times), max(growths))
+
+    if outputs["objects"] != outputs["columnar"]:
+        print "Outputs differ: {}".format(
+            sorted(n for n in outputs["objects"] if outputs["objects"][n] != outputs["columnar"].get(n)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", nargs="?", default="shakespeare_6.0.json", help="Elastic Shakespeare sample data")
+    parser.add_argument("-n", "--repeat", type=int, default=3, help="Number of timed runs of each parser")
+    args = parser.parse_args()
+
+    bench(args.source, args.repeat)
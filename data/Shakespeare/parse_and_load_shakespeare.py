@@ -1,222 +1,151 @@
 # -*- coding: utf-8 -*-
-import django
-django.setup()
-
+"""
+Load the Elastic Shakespeare sample data.  Parsing is in shakespeare.py.
+The Sefaria model is only set up once there's a play to write, so a dry run, which writes the jagged arrays
+as json instead, never sets it up.
+Each play is written as soon as it has been parsed, or read from the cache, so only one play is held at a time.
+
+    python parse_and_load_shakespeare.py [source]
+    python parse_and_load_shakespeare.py --dry-run plays.ndjson [source]
+"""
+import argparse
 import json
-from collections import defaultdict
-from sefaria.model import *
-from pprint import pprint
-
-
-class Play(object):
-    def __init__(self, name):
-        self.name = name
-        self.acts = []
-        self.current_act = 0
-
-    def __str__(self):
-        return self.name
-
-    def add_act(self, first_line):
-        n = Act(first_line)
-        self.acts += [n]
-        self.current_act = len(self.acts)
-        return n
-
-
-class Act(object):
-    def __init__(self, first_line):
-        self.scenes = []
-        self.current_scene = 0
-        self.first_line = first_line
-
-    def __str__(self):
-        return self.first_line.text
-
-    def add_scene(self, first_scene_line):
-        if self.current_scene == 0:
-            n = Scene([self.first_line, first_scene_line])
-        else:
-            n = Scene([first_scene_line])
-        self.scenes += [n]
-        self.current_scene = len(self.scenes)
-        return n
-
-
-class Scene(object):
-    def __init__(self, first_lines):
-        self.lines = first_lines
-        self.first_line = first_lines[-1]
-
-    def __str__(self):
-        return self.first_line.text
-
-    def add_line(self, line):
-        self.lines += [line]
-
-    def array(self):
-        # set blank array to maximum size
-        result = [""] * len(self.lines)
-
-        i = 0
-        accumlator = ""
-
-        while i < len(self.lines):
-            line = self.lines[i]
-
-            if not line.line_num:
-                accumlator += line.complete_text() + "<br>"
-                i += 1
-                continue
-            else:
-                t = accumlator + line.complete_text()
-                num = line.line_num - 1
-                accumlator = ""
-
-            try:
-                while line.nxt and not line.nxt.num and line.speech_num == line.nxt.speech_num:
-                    t += "<br>" + line.nxt.complete_text()
-                    line = line.nxt
-                    i += 1
-            except AttributeError as e:
-                pass
-
-            if num >= len(result):
-                print "Error {}/{}: {}".format(num,len(result),t)
-            result[num] = t
-            i += 1
-
-        # trim off end of array
-        while result[-1] == "":
-            result.pop()
-
-        return result
-
-
-class Line(object):
-    def __init__(self, type, id, num, speaker, speech_num, text):
-        self.type = type
-        self.id = id
-        self.num = num if "." in num else None
-        self.derive_numbers()
-        self.speech_num = speech_num
-        self.text = text
-        self.speaker = speaker
-        self.prev = None
-        self.nxt = None
-
-    def derive_numbers(self):
-        self.line_num = None
-        self.act_num = None
-        self.scene_num = None
-        if self.num:
-            self.act_num, self.scene_num, self.line_num = map(int, self.num.split("."))
-
-    def __str__(self):
-        return "{} {}".format(self.num, self.text)
-
-    def __repr__(self):
-        return str(self)
-
-    def set_previous_line(self, prev):
-        self.prev = prev
-        if prev:
-            prev.nxt = self
-
-    def matches_previous_speaker(self):
-        return self.prev and self.speaker == self.prev.speaker
-
-    def complete_text(self):
-        txt = "<em>{}</em><br>".format(self.text) if self.type == "line" and not self.num else self.text
-        if self.type in ["act", "scene"]:
-            return "&emsp;&emsp;&emsp;&emsp;{}".format(txt)
-        if not self.speaker or self.matches_previous_speaker():
-            return "&emsp;" + txt
-        else:
-            return "{}<br>&emsp;{}".format(self.speaker, txt)
-
-# line_id
-# line_number
-# play_name
-# speaker
-# speech_number
-# text_entry
-# type  -  u'act', u'line', u'scene'
+import os
+import sys
 
-plays = {}
-data = json.load(open('shakespeare_6.0.json'))
+from shakespeare import DIAGNOSTICS, PARSER_VERSION, iter_plays, parse_plays
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import model, parse_cache
 
-prev_number = None
-for d in data:
-    if d["line_number"] == prev_number:
-        d["line_number"] = ""
-    else:
-        prev_number = d["line_number"]
-
-play = None
-act = None
-scene = None
-prev_line = None
 
-for d in data:
-    if d["play_name"] in ["Henry V", "Henry VIII", "Pericles", "Taming of the Shrew", "Merchant of Venice", "Romeo and Juliet", "Troilus and Cressida"]:
-        continue  # "Henry V", "Henry VIII", "Pericles", "Taming of the Shrew", RAJ, TAC have lines outside of a scene, or scenes outside acts.
-                  # MOV has bad data - Act I, Scene II is misnumbered
-    try:
-        play = plays[d["play_name"]]
-    except KeyError:
-        play = Play(d["play_name"])
-        plays[d["play_name"]] = play
-        act = None
-        scene = None
-        prev_line = None
-
-    line = Line(d["type"], d["line_id"], d["line_number"], d["speaker"], d["speech_number"], d["text_entry"])
-
-    try:
-        type = d["type"]
-        if type == "act":
-            prev_line = None
-            act = play.add_act(line)
-        elif type == "scene":
-            scene = act.add_scene(line)
-        elif type == "line":
-            scene.add_line(line)
-
-        line.set_previous_line(prev_line)
-        prev_line = line
-    except Exception as e:
-        print vars(line)
-        print e
-
-for name, play in plays.iteritems():
+def make_index(name):
     hname = u"א" + name
-    index = Index()
+    models = model.load()
+    index = models.Index()
     index.set_title(name)
     index.categories = ["Drama", "Shakespeare"]
 
-    root = JaggedArrayNode()
+    root = models.JaggedArrayNode()
     root.add_primary_titles(name, hname)
     root.add_structure(["Act", "Scene", "Line"])
     root.index = index
 
     index.nodes = root
+    return index
 
-    IndexSet({"title":name}).delete()
+
+def make_version(name, data):
+    v = model.load().Version()
+    v.versionTitle = "Elastic Search"
+    v.versionSource = "https://www.elastic.co/guide/en/kibana/current/tutorial-load-dataset.html"
+    v.language = "en"
+    v.chapter = data
+    v.title = name
+    return v
+
+
+def save_play(name, data):
+    index = make_index(name)
+    models = model.load()
+
+    models.IndexSet({"title":name}).delete()
 
     try:
         index.save()
     except Exception:
         pass
 
-    data = [[scene.array() for scene in act.scenes] for act in play.acts]
+    models.VersionSet({"title":name}).delete()
+    make_version(name, data).save()
+
+
+def cached_plays(cache, source, parse):
+    """
+    Each play from the cache if it's there, and otherwise as it's parsed, caching it on the way.
+    Plays are cached one by one, with the list of their names stored once all of them are,
+    so that a run never has to hold more than one play.
+    :param parse: function of the source that returns an iterator of (play name, jagged array)
+    :return: iterator of (play name, jagged array)
+    """
+    key = cache.key(source, PARSER_VERSION, "shakespeare", "plays")
+    names = cache.get(key)
+    done = set()
+    if names is not None:
+        for name in names:
+            data = cache.get(cache.subkey(key, name))
+            if data is None:
+                # Evicted.  Parse again, for the plays from here on.
+                break
+            done.add(name)
+            yield name, data
+        else:
+            return
+
+    names = []
+    for name, data in parse(source):
+        names += [name]
+        if name not in done:
+            cache.put(cache.subkey(key, name), data)
+            yield name, data
+    cache.put(key, names)
+
+
+def dump_plays(plays, out):
+    """Write each play to out as a line of json, instead of to the database"""
+    for name, data in plays:
+        out.write(json.dumps({
+            "title": name,
+            "versionTitle": "Elastic Search",
+            "language": "en",
+            "sectionNames": ["Act", "Scene", "Line"],
+            "chapter": data,
+        }) + "\n")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", nargs="?", default="shakespeare_6.0.json",
+                        help="Elastic Shakespeare sample data, as a json array or newline delimited bulk upload file")
+    parser.add_argument("--no-cache", action="store_true", help="Always parse, and don't store results in the cache")
+    parser.add_argument("--cache-dir", default=parse_cache.DEFAULT_DIRECTORY, help="Parse cache directory")
+    parser.add_argument("--cache-max-mb", type=int, default=parse_cache.DEFAULT_MAX_BYTES / (1024 * 1024),
+                        help="Size cap for the parse cache, in MB")
+    parser.add_argument("--bulk", action="store_true",
+                        help="Write all records in bulk at the end of the run, and update counts and the toc once")
+    parser.add_argument("--objects", action="store_true",
+                        help="Parse with a Line object per row, rather than by columns.  The output is the same.")
+    parser.add_argument("--dry-run", metavar="FILE",
+                        help="Parse only, and write each play to FILE as a line of json, or to stdout for '-'. "
+                             "Nothing is written to the database.")
+    args = parser.parse_args()
+
+    if args.objects:
+        # The Line parser builds every play before returning any
+        parse = lambda source: parse_plays(source).iteritems()
+    else:
+        parse = iter_plays
+    if args.no_cache:
+        plays = parse(args.source)
+    else:
+        cache = parse_cache.ParseCache(args.cache_dir, args.cache_max_mb * 1024 * 1024)
+        plays = cached_plays(cache, args.source, parse)
+
+    if args.dry_run == "-":
+        dump_plays(plays, sys.stdout)
+    elif args.dry_run:
+        with open(args.dry_run, "w") as f:
+            dump_plays(plays, f)
+    elif args.bulk:
+        from common.bulk import BulkLoader
+        bulk_loader = BulkLoader()
+        for name, data in plays:
+            bulk_loader.add_index(make_index(name))
+            bulk_loader.add_version(make_version(name, data))
+        bulk_loader.flush()
+    else:
+        for name, data in plays:
+            save_play(name, data)
 
-    VersionSet({"title":name}).delete()
-    v = Version()
-    v.versionTitle = "Elastic Search"
-    v.versionSource = "https://www.elastic.co/guide/en/kibana/current/tutorial-load-dataset.html"
-    v.language = "en"
-    v.chapter = data
-    v.title = name
-    v.save()
+    for problem, count in sorted(DIAGNOSTICS.items()):
+        print >> sys.stderr, "{}: {}".format(problem, count)
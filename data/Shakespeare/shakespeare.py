@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+"""
+Parsing of the Elastic Shakespeare sample data into a jagged array of Act / Scene / Line per play.
+
+Nothing here needs Django or the Sefaria model.  parse_and_load_shakespeare.py writes the results to the database.
+"""
+import codecs
+import json
+from collections import Counter
+from itertools import groupby
+from operator import itemgetter
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+class Play(object):
+    def __init__(self, name):
+        self.name = name
+        self.acts = []
+        self.current_act = 0
+
+    def __str__(self):
+        return self.name
+
+    def add_act(self, first_line):
+        n = Act(first_line)
+        self.acts += [n]
+        self.current_act = len(self.acts)
+        return n
+
+
+class Act(object):
+    def __init__(self, first_line):
+        self.scenes = []
+        self.current_scene = 0
+        self.first_line = first_line
+
+    def __str__(self):
+        return self.first_line.text
+
+    def add_scene(self, first_scene_line):
+        if self.current_scene == 0:
+            n = Scene([self.first_line, first_scene_line])
+        else:
+            n = Scene([first_scene_line])
+        self.scenes += [n]
+        self.current_scene = len(self.scenes)
+        return n
+
+
+class Scene(object):
+    def __init__(self, first_lines):
+        self.lines = first_lines
+        self.first_line = first_lines[-1]
+
+    def __str__(self):
+        return self.first_line.text
+
+    def add_line(self, line):
+        self.lines += [line]
+
+    def array(self):
+        return scene_array(
+            (line.line_num, bool(line.num), line.speech_num, i > 0 and line.prev is self.lines[i - 1],
+             line.complete_text())
+            for i, line in enumerate(self.lines))
+
+
+class Line(object):
+    def __init__(self, type, id, num, speaker, speech_num, text):
+        self.type = type
+        self.id = id
+        self.num = num if "." in num else None
+        self.derive_numbers()
+        self.speech_num = speech_num
+        self.text = text
+        self.speaker = speaker
+        self.prev = None
+        self.nxt = None
+
+    def derive_numbers(self):
+        self.line_num = None
+        self.act_num = None
+        self.scene_num = None
+        if self.num:
+            self.act_num, self.scene_num, self.line_num = map(int, self.num.split("."))
+
+    def __str__(self):
+        return "{} {}".format(self.num, self.text)
+
+    def __repr__(self):
+        return str(self)
+
+    def set_previous_line(self, prev):
+        self.prev = prev
+        if prev:
+            prev.nxt = self
+
+    def matches_previous_speaker(self):
+        return self.prev and self.speaker == self.prev.speaker
+
+    def complete_text(self):
+        txt = "<em>{}</em><br>".format(self.text) if self.type == "line" and not self.num else self.text
+        if self.type in ["act", "scene"]:
+            return "&emsp;&emsp;&emsp;&emsp;{}".format(txt)
+        if not self.speaker or self.matches_previous_speaker():
+            return "&emsp;" + txt
+        else:
+            return "{}<br>&emsp;{}".format(self.speaker, txt)
+
+# Counts of problems with line numbers met while assembling scenes
+DIAGNOSTICS = Counter()
+
+
+def scene_array(rows):
+    """
+    Assemble a scene into one entry per line number.
+    An unnumbered row continues the line before it if it follows on in the same speech,
+    and otherwise is prefixed to the next numbered line.
+    :param rows: for each row of the scene, a tuple of
+        (line number, whether the row has a line number, speech number, whether it follows on from the row before, text)
+    """
+    numbered_lines = []
+    accumulator = []
+    parts = None  # fragments of the line being assembled, while rows can still continue it
+    prev_speech = None
+    count = 0
+
+    for line_num, numbered, speech_num, follows, text in rows:
+        if parts is not None and follows and not numbered and speech_num == prev_speech:
+            parts += ["<br>", text]
+        elif line_num:
+            parts = accumulator + [text]
+            accumulator = []
+            numbered_lines += [(line_num, parts)]
+        else:
+            accumulator += [text, "<br>"]
+            parts = None
+        prev_speech = speech_num
+        count += 1
+
+    result = [""] * max([n for n, _ in numbered_lines] + [0])
+    for n, parts in numbered_lines:
+        if n < 1:
+            DIAGNOSTICS["line number below 1, dropped"] += 1
+            continue
+        if n > count:
+            DIAGNOSTICS["line number past the scene's row count"] += 1
+        if result[n - 1]:
+            DIAGNOSTICS["repeated line number, earlier line dropped"] += 1
+        result[n - 1] = "".join(parts)
+
+    # trim off end of array
+    while result and result[-1] == "":
+        result.pop()
+
+    return result
+
+
+# line_id
+# line_number
+# play_name
+# speaker
+# speech_number
+# text_entry
+# type  -  u'act', u'line', u'scene'
+
+# "Henry V", "Henry VIII", "Pericles", "Taming of the Shrew", RAJ, TAC have lines outside of a scene, or scenes outside acts.
+# MOV has bad data - Act I, Scene II is misnumbered
+SKIPPED_PLAYS = ["Henry V", "Henry VIII", "Pericles", "Taming of the Shrew", "Merchant of Venice", "Romeo and Juliet", "Troilus and Cressida"]
+
+# Bump when a change to the parser changes its output, to invalidate cached results
+PARSER_VERSION = 2
+
+
+# Action lines of the Elastic bulk upload format, which precede each row
+BULK_ACTIONS = ["index", "create"]
+
+
+def _iter_array(f, chunk_size=1 << 16):
+    """
+    Yield the items of a json array one at a time, decoding only as much of f as is needed.
+    Used when ijson isn't installed.
+    """
+    decoder = json.JSONDecoder()
+    reader = codecs.getreader("utf-8")(f)
+    buf = u""
+    pos = 0
+    started = False
+
+    while True:
+        while pos < len(buf) and buf[pos] in u" \t\r\n,\ufeff":
+            pos += 1
+        if pos < len(buf):
+            if not started:
+                if buf[pos] != u"[":
+                    raise ValueError("Expected a json array")
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == u"]":
+                return
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                end = None
+            # An item that runs to the end of the buffer may be cut short.  There's always at least a "]" after it.
+            if end is not None and end < len(buf):
+                yield item
+                pos = end
+                continue
+
+        chunk = reader.read(chunk_size)
+        if not chunk:
+            raise ValueError("Unexpected end of json array")
+        buf = buf[pos:] + chunk
+        pos = 0
+
+
+def iter_rows(filename):
+    """
+    Yield the rows of the Elastic Shakespeare data one at a time.
+    Accepts either a json array of rows, or newline delimited json such as the bulk upload file,
+    whose action lines are skipped.
+    """
+    with open(filename, "rb") as f:
+        start = f.read(64).lstrip(codecs.BOM_UTF8 + " \t\r\n")
+        f.seek(0)
+        if start.startswith("["):
+            rows = ijson.items(f, "item") if ijson else _iter_array(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+
+        for row in rows:
+            if len(row) == 1 and row.keys()[0] in BULK_ACTIONS:
+                continue
+            yield row
+
+
+def read_rows(filename):
+    """
+    :return: iterator of rows from the Elastic json, with repeated line numbers blanked
+    """
+    prev_number = None
+    for d in iter_rows(filename):
+        if d["line_number"] == prev_number:
+            d["line_number"] = ""
+        else:
+            prev_number = d["line_number"]
+        yield d
+
+
+def build_plays(data):
+    """
+    :return: dict of play name to Play
+    """
+    plays = {}
+
+    play = None
+    act = None
+    scene = None
+    prev_line = None
+
+    for d in data:
+        if d["play_name"] in SKIPPED_PLAYS:
+            continue
+        try:
+            play = plays[d["play_name"]]
+        except KeyError:
+            play = Play(d["play_name"])
+            plays[d["play_name"]] = play
+            act = None
+            scene = None
+            prev_line = None
+
+        line = Line(d["type"], d["line_id"], d["line_number"], d["speaker"], d["speech_number"], d["text_entry"])
+
+        try:
+            type = d["type"]
+            if type == "act":
+                prev_line = None
+                act = play.add_act(line)
+            elif type == "scene":
+                scene = act.add_scene(line)
+            elif type == "line":
+                scene.add_line(line)
+
+            line.set_previous_line(prev_line)
+            prev_line = line
+        except Exception as e:
+            print vars(line)
+            print e
+
+    return plays
+
+
+def parse_plays(filename):
+    """
+    :return: dict of play name to jagged array of Act / Scene / Line
+    """
+    plays = build_plays(read_rows(filename))
+    return {name: [[scene.array() for scene in act.scenes] for act in play.acts] for name, play in plays.iteritems()}
+
+
+# Columnar parsing.
+# Rather than a linked Line object per row, each field of a play is read into its own list,
+# and acts and scenes are ranges of row indexes.  The output is the same as parse_plays().
+
+COLUMNS = ["play_name", "type", "line_id", "line_number", "speaker", "speech_number", "text_entry"]
+
+
+def _line_num(number):
+    if "." not in number:
+        return None
+    act_num, scene_num, line_num = map(int, number.split("."))
+    return line_num
+
+
+def _complete_text(type, numbered, speaker, same_speaker, text):
+    # As Line.complete_text()
+    txt = "<em>{}</em><br>".format(text) if type == "line" and not numbered else text
+    if type in ["act", "scene"]:
+        return "&emsp;&emsp;&emsp;&emsp;{}".format(txt)
+    if not speaker or same_speaker:
+        return "&emsp;" + txt
+    else:
+        return "{}<br>&emsp;{}".format(speaker, txt)
+
+
+class PlayColumns(object):
+    """
+    The rows of one play, as a dict of field name to list of values.
+    Each row follows on from the row before it, unless it begins an act.
+    """
+    def __init__(self, columns):
+        self.types = columns["type"]
+        self.speech_nums = columns["speech_number"]
+        numbers = columns["line_number"]
+        speakers = columns["speaker"]
+
+        self.numbered = ["." in n for n in numbers]
+        self.line_nums = [_line_num(n) for n in numbers]
+        self.linked = [False] + [t != "act" for t in self.types[1:]]
+        same_speaker = [False] + [speakers[i] == speakers[i - 1] for i in xrange(1, len(speakers))]
+        self.texts = [_complete_text(*row) for row in zip(
+            self.types, self.numbered, speakers, [l and s for l, s in zip(self.linked, same_speaker)],
+            columns["text_entry"])]
+
+    def scene_ranges(self):
+        """
+        :return: list of acts, each a list of (start, end) row ranges of its scenes.
+            The first scene of each act includes the act's own row.
+            None if the play has rows outside of a scene, or scenes outside of an act.
+        """
+        heads = [i for i, t in enumerate(self.types) if t != "line"]
+        if not heads or heads[0] != 0:
+            return None
+
+        acts = []
+        for h, i in enumerate(heads):
+            type = self.types[i]
+            if type == "act":
+                if i + 1 == len(self.types) or self.types[i + 1] != "scene":
+                    return None
+                acts += [[]]
+            elif type == "scene":
+                first = i - 1 if self.types[i - 1] == "act" else i
+                end = heads[h + 1] if h + 1 < len(heads) else len(self.types)
+                acts[-1] += [(first, end)]
+            else:
+                return None
+        return acts
+
+    def scene(self, start, end):
+        """
+        As Scene.array(), for the scene made of rows start to end.
+        """
+        return scene_array(zip(
+            self.line_nums[start:end], self.numbered[start:end], self.speech_nums[start:end],
+            [False] + self.linked[start + 1:end], self.texts[start:end]))
+
+
+def parse_play(name, rows):
+    """
+    :param rows: all of the rows of one play
+    :return: jagged array of Act / Scene / Line
+    """
+    play = PlayColumns({field: [d[field] for d in rows] for field in COLUMNS})
+    acts = play.scene_ranges()
+    if acts is None:
+        # Leave plays with stray rows to the Line parser, and its rules for where they end up
+        return [[scene.array() for scene in act.scenes] for act in build_plays(rows)[name].acts]
+    return [[play.scene(first, stop) for first, stop in act] for act in acts]
+
+
+def iter_plays(filename):
+    """
+    Parse each play as soon as its last row has been read, so that only one play's rows are held at a time.
+    :return: iterator of (play name, jagged array of Act / Scene / Line)
+    """
+    seen = set()
+    for name, rows in groupby(read_rows(filename), key=itemgetter("play_name")):
+        if name in SKIPPED_PLAYS:
+            continue
+        if name in seen:
+            raise ValueError(u"Rows of {} are not contiguous".format(name))
+        seen.add(name)
+        yield name, parse_play(name, list(rows))
+
+
+def parse_plays_columnar(filename):
+    """
+    :return: dict of play name to jagged array of Act / Scene / Line
+    """
+    return dict(iter_plays(filename))
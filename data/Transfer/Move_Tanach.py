@@ -1,16 +1,23 @@
 # -*- coding: utf-8 -*-
 
-import django
-django.setup()
 import argparse
 import os
+import sys
 import json
+import Queue
+import threading
 import urllib
-import urllib2
+from multiprocessing.pool import ThreadPool
+
 import requests
 
-from sefaria.model import *
-from sefaria.datatype.jagged_array import JaggedTextArray, JaggedArray
+from transport import Transport, FailureLedger, replay, DEFAULT_POOL_SIZE
+from destination import DestinationCache
+from manifest import Manifest
+
+# The Sefaria model is set up on first use, so that importing this, or running with --replay, doesn't set it up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import model
 
 try:
     from sefaria.local_settings import SEFARIA_BOT_API_KEY
@@ -18,9 +25,39 @@ except ImportError:
     SEFARIA_BOT_API_KEY = None
 
 
+class _Done(object):
+    def get(self):
+        pass
+
+
+def link_query(title, which):
+    """
+    :param which: 1 for manual links only, 2 for auto links as well
+    """
+    if which == 1: # only manual
+        return {"$and" : [{ "refs": {"$regex": model.load().Ref(title).regex()}}, { "$or" : [ { "auto" : False }, { "auto" : 0 }, {"auto" :{ "$exists": False}} ] } ]}
+    else:
+        return {"refs": {"$regex": model.load().Ref(title).regex()}}
+
+
 class ServerTextCopier(object):
 
-    def __init__(self, dest_server, apikey, title, post_index=True, versions=None, post_links=False, new_cats=None):
+    def __init__(self, dest_server, apikey, title, post_index=True, versions=None, post_links=False, new_cats=None,
+                 transport=None, pool=None, setup_lock=None, destination=None, manifest=None,
+                 link_batch_size=500, prefetch=32):
+        """
+        :param transport: Transport to make requests with.  Pass the same one to every copier in a run,
+            so that they share its connections.
+        :param pool: ThreadPool to post text nodes on concurrently.  If None, they are posted one at a time.
+        :param setup_lock: Lock held while posting terms, categories and the index.  Copiers that run at the same time
+            should share one, since they create the same terms and categories.
+        :param destination: DestinationCache of the terms and categories on the destination.  Share one between
+            copiers, so that each is only looked up once.
+        :param manifest: Manifest of what was posted to the destination before.  If given, only text nodes and
+            version flags that have changed since are posted.
+        :param link_batch_size: number of links read from the database and posted at a time
+        :param prefetch: number of text payloads to prepare ahead of the posts, and to have waiting on the pool
+        """
         self._dest_server = dest_server
         self._apikey = apikey
         self._title_to_retrieve = title
@@ -28,6 +65,15 @@ class ServerTextCopier(object):
         self._post_index = post_index
         self._post_links = post_links
         self._new_cats = new_cats
+        self._transport = transport or Transport()
+        self._pool = pool
+        self._setup_lock = setup_lock or threading.Lock()
+        self._destination = destination or DestinationCache(self._transport, dest_server)
+        self._manifest = manifest
+        self._link_batch_size = link_batch_size
+        self._prefetch = prefetch
+        # Held while a post is waiting on the pool or being made, so that payloads don't pile up in its queue
+        self._outstanding = threading.BoundedSemaphore(prefetch)
 
     def post_terms_from_schema(self):
 
@@ -45,17 +91,14 @@ class ServerTextCopier(object):
         possible_terms.update(self._index_obj.categories)
         if hasattr(self._index_obj, u'collective_title'):
             possible_terms.add(self._index_obj.collective_title)
-        necessary_terms = []
-        for t in possible_terms:
-            response = requests.get(u'{}/api/terms/{}'.format(self._dest_server, t))
-            if response.json().get('error', '') == "Term does not exist.":
-                necessary_terms.append(t)
+        necessary_terms = [t for t in possible_terms if not self._destination.has_term(t)]
         for t in necessary_terms:
             self._upload_term(t)
 
 
     def load_objects(self):
-        self._index_obj = library.get_index(self._title_to_retrieve)
+        models = model.load()
+        self._index_obj = models.library.get_index(self._title_to_retrieve)
         if self._new_cats:
             self._index_obj.categories = self._new_cats
         if not self._index_obj:
@@ -63,106 +106,231 @@ class ServerTextCopier(object):
         self._version_objs = []
         if self._versions_to_retrieve:
             if self._versions_to_retrieve == 'all':
-                self._version_objs = VersionSet({'title': self._title_to_retrieve}).array()
+                self._version_objs = models.VersionSet({'title': self._title_to_retrieve}).array()
             else:
                 for version in self._versions_to_retrieve:
-                    version['title'] = self._title_to_retrieve
-                    vs = Version().load(version)
+                    # copy, since the list is shared by copiers running at the same time
+                    version = dict(version, title=self._title_to_retrieve)
+                    vs = models.Version().load(version)
                     if not vs:
                         print "Warning: No version object found for  lang: {} version title: {}. Skipping.".format(version['language'], version['versionTitle'])
                     else:
                         self._version_objs.append(vs)
         if self._post_links:
-            if self._post_links == 1: # only manual
-                query = {"$and" : [{ "refs": {"$regex": Ref(self._index_obj.title).regex()}}, { "$or" : [ { "auto" : False }, { "auto" : 0 }, {"auto" :{ "$exists": False}} ] } ]}
-            else:
-                query = {"refs": {"$regex": Ref(self._index_obj.title).regex()}}
-
-            self._linkset = LinkSet(query).array()
+            # Links are read as they're posted, rather than loaded here
+            self._link_query = link_query(self._index_obj.title, self._post_links)
 
     def do_copy(self):
-        self.load_objects()
+        with self._transport.stats.timer("load"):
+            self.load_objects()
         if self._post_index:
-            idx_contents = self._index_obj.contents(raw=True)
-
-            idx_title = self._index_obj.title
-            self.post_terms_from_schema()
-            self._handle_categories()
-            self._make_post_request_to_server(self._prepare_index_api_call(idx_title), idx_contents)
-        content_nodes = self._index_obj.nodes.get_leaf_nodes()
-        for ver in self._version_objs:
-            found_non_empty_content = False
-            print ver.versionTitle.encode('utf-8')
-            flags = {}
-            for flag in ver.optional_attrs:
-                if hasattr(ver, flag):
-                    flags[flag] = getattr(ver, flag, None)
-            for node_num, node in enumerate(content_nodes,1):
-                print node.full_title(force_update=True)
-                text = JaggedTextArray(ver.content_node(node)).array()
-                version_payload = {
-                        "versionTitle": ver.versionTitle,
-                        "versionSource": ver.versionSource,
-                        "language": ver.language,
-                        "text": text
-                }
-                if len(text) > 0:
-                    # only bother posting nodes that have content.
-                    found_non_empty_content = True
-                    if node_num == len(content_nodes):
-                        self._make_post_request_to_server(self._prepare_text_api_call(
-                            node.full_title(force_update=True), count_after=True), version_payload)
-                    else:
-                        self._make_post_request_to_server(self._prepare_text_api_call(
-                            node.full_title(force_update=True)), version_payload)
-            if not found_non_empty_content:
-                # post the last node again with dummy text, to make sure an actual version db object is created
-                # then post again to clear the dummy text
-                dummy_text = "This is a dummy text"
-                empty = ""
-                for _ in range(node.depth):
-                    dummy_text = [dummy_text]
-                    empty = [empty]
-                version_payload['text'] = dummy_text
-                self._make_post_request_to_server(self._prepare_text_api_call(node.full_title()), version_payload)
-                version_payload['text'] = empty
-                self._make_post_request_to_server(self._prepare_text_api_call(node.full_title()), version_payload)
-            if flags:
-                self._make_post_request_to_server(self._prepare_version_attrs_api_call(ver.title, ver.language, ver.versionTitle), flags)
+            with self._setup_lock:
+                idx_contents = self._index_obj.contents(raw=True)
+
+                idx_title = self._index_obj.title
+                self.post_terms_from_schema()
+                self._handle_categories()
+                self._make_post_request_to_server(self._prepare_index_api_call(idx_title), idx_contents)
+        self._make_copy_plan()
+
+        # Payloads are prepared on another thread, and posted as they become ready
+        prepared = Queue.Queue(self._prefetch)
+        producer = threading.Thread(target=self._produce, args=(prepared,))
+        producer.daemon = True
+        producer.start()
+
+        flag_posts = []
+        in_flight = []
+        held = None
+        # Versions with a text post the destination has accepted, so that the Version exists there
+        started = set()
+        while True:
+            item = prepared.get()
+            if item is None:
+                break
+            kind, post = item
+            if kind == "error":
+                raise post[0], post[1], post[2]
+            if kind == "flags":
+                if self._manifest is None or self._manifest.changed(post[2], post[1]):
+                    flag_posts.append(post)
+                continue
+            if self._manifest is not None and not self._manifest.changed(*self._manifest_entry(post)):
+                continue
+            # Counts are updated once for the index, with the last post.  Which one that is isn't known
+            # until the producer is done, so one is held back.
+            if held is not None:
+                in_flight.append(self._post_after_first(held, started))
+            held = post
+        producer.join()
+
+        for result in in_flight:
+            result.get()
+        if held is not None:
+            self._post_texts(held, count_after=True)
+        for url, flags, key in flag_posts:
+            if self._make_post_request_to_server(url, flags) and self._manifest is not None:
+                self._manifest.record(key, flags)
         if self._post_links:
-            links = [l.contents() for l in self._linkset if not getattr(l, 'source_text_oid', None)]
-            self._make_post_request_to_server(self._prepare_links_api_call(), links)
+            self._copy_links()
+
+    def _make_copy_plan(self):
+        """Work out each leaf node's title and text API path once, for every version"""
+        self._plan = []
+        self._text_urls = {}
+        for node in self._index_obj.nodes.get_leaf_nodes():
+            title = node.full_title(force_update=True)
+            self._plan.append((node, title))
+            self._text_urls[title] = self._prepare_text_api_call(title)
+
+    def _produce(self, prepared):
+        """
+        Put ("text", [(ref, payload), ...]) for each list of text posts that have to be made in order,
+        and ("flags", (url, flags, manifest key)) for each version's flags, on the queue, and then None.
+        If preparing fails, ("error", sys.exc_info()) is put before the None.
+        """
+        from sefaria.datatype.jagged_array import JaggedTextArray
+        try:
+            for ver in self._version_objs:
+                found_non_empty_content = False
+                print ver.versionTitle.encode('utf-8')
+                flags = {}
+                for flag in ver.optional_attrs:
+                    if hasattr(ver, flag):
+                        flags[flag] = getattr(ver, flag, None)
+                for node, title in self._plan:
+                    print title
+                    with self._transport.stats.timer("extract"):
+                        text = JaggedTextArray(ver.content_node(node)).array()
+                    version_payload = {
+                            "versionTitle": ver.versionTitle,
+                            "versionSource": ver.versionSource,
+                            "language": ver.language,
+                            "text": text
+                    }
+                    if len(text) > 0:
+                        # only bother posting nodes that have content.
+                        found_non_empty_content = True
+                        prepared.put(("text", [(title, version_payload)]))
+                if not found_non_empty_content:
+                    # post the last node again with dummy text, to make sure an actual version db object is created
+                    # then post again to clear the dummy text
+                    dummy_text = "This is a dummy text"
+                    empty = ""
+                    for _ in range(node.depth):
+                        dummy_text = [dummy_text]
+                        empty = [empty]
+                    prepared.put(("text", [(title, dict(version_payload, text=dummy_text)),
+                                           (title, dict(version_payload, text=empty))]))
+                if flags:
+                    # The version has to exist at the destination first, so these are posted after the texts
+                    prepared.put(("flags", (self._prepare_version_attrs_api_call(ver.title, ver.language, ver.versionTitle),
+                                            flags, Manifest.key("flags", ver.title, ver.language, ver.versionTitle))))
+        except Exception:
+            prepared.put(("error", sys.exc_info()))
+        finally:
+            prepared.put(None)
+
+    def _post_texts(self, posts, count_after=False):
+        """:return: True if every post was accepted"""
+        ok = True
+        for i, (ref, payload) in enumerate(posts, 1):
+            if count_after and i == len(posts):
+                url = self._prepare_text_api_call(ref, count_after=True)
+            else:
+                url = self._text_urls[ref]
+            ok = self._make_post_request_to_server(url, payload) and ok
+        if ok and self._manifest is not None:
+            self._manifest.record(*self._manifest_entry(posts))
+        return ok
+
+    @staticmethod
+    def _manifest_entry(posts):
+        # What the destination holds after a list of posts to one node is the last payload
+        ref, payload = posts[-1]
+        return Manifest.key("text", payload["language"], payload["versionTitle"], ref), payload
+
+    def _post_after_first(self, posts, started):
+        """
+        Post a version's texts one at a time until one is accepted, and on the pool after that.
+        Otherwise concurrent posts to a version the destination doesn't have yet could each create it.
+        :param started: versions that have had a post accepted.  Updated here.
+        :return: something to get() once the posts are done
+        """
+        ref, payload = posts[0]
+        version = (payload["language"], payload["versionTitle"])
+        if version in started:
+            return self._post_async(posts)
+        if self._post_texts(posts):
+            started.add(version)
+        return _Done()
+
+    def _post_async(self, posts):
+        """
+        Blocks while prefetch posts are outstanding.
+        :return: something to get() once the posts are done
+        """
+        if self._pool is None:
+            self._post_texts(posts)
+            return _Done()
+        self._outstanding.acquire()
+        return self._pool.apply_async(self._post_outstanding, (posts,))
+
+    def _post_outstanding(self, posts):
+        try:
+            self._post_texts(posts)
+        finally:
+            self._outstanding.release()
+
+    def _copy_links(self):
+        counts = {"posted": 0, "failed": 0}
+
+        def post(batch):
+            accepted = self._make_post_request_to_server(self._prepare_links_api_call(), batch)
+            counts["posted" if accepted else "failed"] += len(batch)
+            print "{}: {posted} links posted, {failed} failed".format(self._index_obj.title, **counts)
+
+        batch = []
+        Link = model.load().Link
+        cursor = model.database().links.find(self._link_query, no_cursor_timeout=True).batch_size(self._link_batch_size)
+        try:
+            for record in cursor:
+                if record.get('source_text_oid'):
+                    continue
+                batch.append(Link(record).contents())
+                if len(batch) == self._link_batch_size:
+                    post(batch)
+                    batch = []
+        finally:
+            cursor.close()
+        if batch:
+            post(batch)
 
     def _handle_categories(self):
         if getattr(self, '_index_obj') is None:
             return
         categories = self._index_obj.categories
-        try:
-            dest_category = requests.get(u'{}/api/category/{}'.format(self._dest_server, u'/'.join(categories))).json()
-        except ValueError:
+        cat_index = self._destination.existing_depth(categories)
+        if cat_index is None:
             return
 
-        if dest_category.get('error') == u'Category not found':
-            if dest_category.get('closest_parent'):
-                cat_index = len(dest_category['closest_parent']['path'])
-            else:
-                cat_index = 0
-
-            # upload necessary category items
-            for i in range(cat_index+1, len(categories)+1):
-                c = Category().load({'path': categories[:i]})
-                if c is None:
-                    raise IndexError("Necessary category for this index is missing. "
-                                     "Path {} was not found".format(categories[:i]))
-                if getattr(c, 'sharedTitle', None) is not None:
-                    self._upload_term(c.sharedTitle)
-                self._make_post_request_to_server("api/category", c.contents())
+        # upload necessary category items
+        for i in range(cat_index+1, len(categories)+1):
+            c = model.load().Category().load({'path': categories[:i]})
+            if c is None:
+                raise IndexError("Necessary category for this index is missing. "
+                                 "Path {} was not found".format(categories[:i]))
+            if getattr(c, 'sharedTitle', None) is not None and not self._destination.has_term(c.sharedTitle):
+                self._upload_term(c.sharedTitle)
+            if self._make_post_request_to_server("api/category", c.contents()):
+                self._destination.add_category(categories[:i])
 
     def _upload_term(self, name):
-        t = Term().load({'name': name})
+        t = model.load().Term().load({'name': name})
         if t is None:
             raise AttributeError("Necessary Term {} not Present on this Environment".format(name))
-        self._make_post_request_to_server('api/terms/{}'.format(urllib.quote(name)), t.contents())
+        if self._make_post_request_to_server('api/terms/{}'.format(urllib.quote(name)), t.contents()):
+            self._destination.add_term(name)
 
     def _prepare_index_api_call(self, index_title):
         return 'api/v2/raw/index/{}'.format(index_title.replace(" ", "_"))
@@ -177,23 +345,70 @@ class ServerTextCopier(object):
         return "api/links/"
 
     def _make_post_request_to_server(self, url, payload):
+        """
+        :return: True if the destination accepted the post.  Transient failures have already been retried
+            by the transport, and failures are recorded in its ledger.
+        """
         full_url = "{}/{}".format(self._dest_server, url)
         jpayload = json.dumps(payload)
         values = {'json': jpayload, 'apikey': self._apikey}
-        data = urllib.urlencode(values)
-        req = urllib2.Request(full_url, data)
         try:
-            response = urllib2.urlopen(req)
-            if 'prof' in full_url:
-                filename = '/var/tmp/prof_mdt_{}_{}.txt'.format(payload['versionTitle'][:5], payload['language'])
-                with open(filename, 'wb+') as filep:
-                    filep.write(response.read())
-                print "{}. Profiling Saved at: {}".format(response.read(), filename)
-            else:
-                print response.read()
-        except urllib2.HTTPError, e:
-            print 'Error code: ', e.code
-            print e.read()
+            response = self._transport.post(full_url, values)
+        except requests.RequestException as e:
+            print 'Error: ', e
+            return False
+        if response.status_code >= 400:
+            print 'Error code: ', response.status_code
+            print response.content
+        elif 'prof' in full_url:
+            filename = '/var/tmp/prof_mdt_{}_{}.txt'.format(payload['versionTitle'][:5], payload['language'])
+            with open(filename, 'wb+') as filep:
+                filep.write(response.content)
+            print "{}. Profiling Saved at: {}".format(response.content, filename)
+        else:
+            print response.content
+        return response.status_code < 400
+
+
+def index_jobs(cats):
+    """
+    :param cats: dict of category path to copy from, as a tuple, to categories to give the copies, or None
+    :return: list of (title, new categories) of every index in those categories
+    """
+    jobs = []
+    for old_cats, new_cats in cats.iteritems():
+        indexes = model.load().IndexSet({"categories": list(old_cats)})
+        for index in indexes:
+            jobs.append((index.title, new_cats))
+    return jobs
+
+
+def copy_indexes(jobs, dest_server, apikey, versions, post_index=True, links=0, transport=None, destination=None,
+                 manifest=None, indexes=2, nodes=8, link_batch_size=500):
+    """
+    Copy each (title, new categories) in jobs, several indexes and several text nodes at a time.
+    :param indexes: number of indexes to copy at the same time
+    :param nodes: number of text nodes to post at the same time, across all indexes
+    """
+    transport = transport or Transport(nodes)
+    if destination is None:
+        destination = DestinationCache(transport, dest_server)
+        destination.seed_from_toc()
+    node_pool = ThreadPool(nodes)
+    setup_lock = threading.Lock()
+
+    def copy(job):
+        title, new_cats = job
+        copier = ServerTextCopier(dest_server, apikey, title, post_index, versions, links, new_cats, transport,
+                                  node_pool, setup_lock, destination, manifest, link_batch_size)
+        copier.do_copy()
+
+    index_pool = ThreadPool(indexes)
+    try:
+        index_pool.map(copy, jobs, chunksize=1)
+    finally:
+        index_pool.close()
+        node_pool.close()
 
 
 if __name__ == '__main__':
@@ -206,6 +421,23 @@ if __name__ == '__main__':
     parser.add_argument("-l", "--links", default=0, type=int, help="Enter '1' to move manual links on this text as well, '2' to move auto links")
     parser.add_argument("-c", "--commentator", default=None, help="Name of commentator with conjoining word if"
                                                                   "necessary. E.g. for Rashi on Tanakh, set to 'Rashi on '")
+    parser.add_argument("--pool-size", default=DEFAULT_POOL_SIZE, type=int, help="Number of connections to keep open to the destination")
+    parser.add_argument("-j", "--indexes", default=2, type=int, help="Number of indexes to copy at the same time")
+    parser.add_argument("--dest-snapshot", help="File of the terms and categories known to be on the destination. "
+                                                "Read at the start of the run if it exists, and written at the end.")
+    parser.add_argument("--manifest", help="Only post text nodes and version flags that have changed since the run that "
+                                           "wrote this manifest file, and update it")
+    parser.add_argument("--link-batch-size", default=500, type=int, help="Number of links to post at a time")
+    parser.add_argument("--stats", help="File to write a json summary of requests and timings to, at the end of the run. "
+                                        "Printed if not given.")
+    parser.add_argument("--retries", default=3, type=int, help="Number of times to retry a request that fails transiently")
+    parser.add_argument("--rate", type=float, help="Most requests to make per second")
+    parser.add_argument("--latency-target", type=float,
+                        help="Seconds. Make fewer requests at once while responses are slower than this.")
+    parser.add_argument("--ledger", help="File to record requests that fail in, to replay later")
+    parser.add_argument("--replay", help="Instead of copying, make the requests recorded in this ledger file again")
+    parser.add_argument("-n", "--nodes", default=8, type=int, help="Number of text nodes to post at the same time, across all indexes")
+    parser.add_argument("--gzip", action="store_true", help="Compress request bodies. The destination must accept gzip encoded requests.")
 
     args = parser.parse_args()
     args.versionlist = "en:The Holy Scriptures: A New Translation (JPS 1917)"
@@ -225,9 +457,34 @@ if __name__ == '__main__':
         ("Tanakh", "Prophets"): ["Religious Texts", "Torah"],
         ("Tanakh", "Writings"): ["Religious Texts", "Torah"]
     }
-    for old_cats, new_cats in cats.iteritems():
-        indexes = IndexSet({"categories": list(old_cats)})
-        for index in indexes:
-            copier = ServerTextCopier(args.destination_server, args.apikey, index.title,
-                                  args.noindex, args.versionlist, args.links, new_cats)
-            copier.do_copy()
+    if args.replay and args.replay == args.ledger:
+        parser.error("--ledger has to be a different file from --replay")
+
+    # One set of connections, and one pool of workers, for the whole run
+    transport = Transport(max(args.pool_size, args.nodes), args.gzip, retries=args.retries, rate=args.rate,
+                          latency_target=args.latency_target, ledger=FailureLedger(args.ledger) if args.ledger else None)
+    if args.replay:
+        print "{} requests succeeded".format(replay(args.replay, transport, args.apikey))
+        sys.exit(0)
+
+    destination = DestinationCache(transport, args.destination_server)
+    if args.dest_snapshot and os.path.exists(args.dest_snapshot):
+        destination.load_snapshot(args.dest_snapshot)
+    else:
+        destination.seed_from_toc()
+    manifest = Manifest(args.manifest, args.destination_server) if args.manifest else None
+
+    try:
+        copy_indexes(index_jobs(cats), args.destination_server, args.apikey, args.versionlist, args.noindex, args.links,
+                     transport, destination, manifest, args.indexes, args.nodes, args.link_batch_size)
+    finally:
+        if args.dest_snapshot:
+            destination.save_snapshot(args.dest_snapshot)
+        if manifest:
+            manifest.save()
+        summary = json.dumps(transport.stats.summary(), indent=2, sort_keys=True)
+        if args.stats:
+            with open(args.stats, "w") as f:
+                f.write(summary)
+        else:
+            print summary
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Time a full category copy against a local stand-in destination (standin_server.py), for several settings.
+
+Each setting copies into a fresh stand-in, so that no run finds terms, categories or texts left by another.
+Reports wall time, text nodes posted per second, requests, errors and retries.
+
+    python bench_copier.py -c Tanakh/Torah --nodes 1,4,8 --indexes 1,2 --latency 0.02
+"""
+import argparse
+import json
+import time
+
+from Move_Tanach import index_jobs, copy_indexes
+from transport import Transport
+from standin_server import StandinServer
+
+
+def run(jobs, versions, links, nodes, indexes, latency, jitter, error_rate, link_batch_size, gzip_bodies):
+    server = StandinServer(latency=latency, jitter=jitter, error_rate=error_rate).start()
+    try:
+        transport = Transport(nodes, gzip_bodies, backoff=0.05, max_backoff=1)
+        start = time.time()
+        copy_indexes(jobs, server.url, "bench", versions, links=links, transport=transport, indexes=indexes,
+                     nodes=nodes, link_batch_size=link_batch_size)
+        wall = time.time() - start
+        transport.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    stats = transport.stats.summary()
+    docs = sum(e["requests"] - e["retries"] for key, e in stats["endpoints"].iteritems() if key == "POST api/texts")
+    return {
+        "nodes": nodes,
+        "indexes": indexes,
+        "wall_seconds": round(wall, 3),
+        "docs": docs,
+        "docs_per_second": round(docs / wall, 1) if wall else None,
+        "links": server.state.links,
+        "requests": stats["requests"],
+        "errors": stats["errors"],
+        "retries": stats["retries"],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--category", action="append", required=True,
+                        help="Category path to copy, with / between categories, e.g. Tanakh/Torah. May be repeated.")
+    parser.add_argument("-v", "--versionlist", default="all",
+                        help="'all', or | separated lang:versionTitle, e.g. en:The Holy Scriptures: A New Translation (JPS 1917)")
+    parser.add_argument("-l", "--links", default=0, type=int, help="Enter '1' to copy manual links as well, '2' for auto links")
+    parser.add_argument("-n", "--nodes", default="1,8", help="Comma separated numbers of text nodes to post at once")
+    parser.add_argument("-j", "--indexes", default="2", help="Comma separated numbers of indexes to copy at once")
+    parser.add_argument("--latency", default=0.02, type=float, help="Seconds the stand-in waits before each response")
+    parser.add_argument("--jitter", default=0, type=float, help="Up to this many more seconds of wait, at random")
+    parser.add_argument("--error-rate", default=0, type=float, help="Share of requests the stand-in answers with a 503")
+    parser.add_argument("--link-batch-size", default=500, type=int, help="Number of links to post at a time")
+    parser.add_argument("--gzip", action="store_true", help="Compress request bodies")
+    parser.add_argument("--json", help="File to write the results to, as json")
+    args = parser.parse_args()
+
+    if args.versionlist == "all":
+        # The copier takes the string 'all' for every version, as Move_Tanach passes it
+        versions = "all"
+    else:
+        versions = [dict(zip(("language", "versionTitle"), v.split(":", 1))) for v in args.versionlist.split("|")]
+    jobs = index_jobs({tuple(c.split("/")): None for c in args.category})
+    print "{} indexes".format(len(jobs))
+
+    results = []
+    for indexes in [int(j) for j in args.indexes.split(",")]:
+        for nodes in [int(n) for n in args.nodes.split(",")]:
+            result = run(jobs, versions, args.links, nodes, indexes, args.latency, args.jitter, args.error_rate,
+                         args.link_batch_size, args.gzip)
+            results.append(result)
+            print "indexes={indexes} nodes={nodes}: {wall_seconds}s, {docs} docs, {docs_per_second} docs/s, " \
+                  "{requests} requests, {errors} errors, {retries} retries".format(**result)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2, sort_keys=True)
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Move texts between environments with a file, instead of posting them to a server.
+
+export writes the Indexes under some categories, with their Terms, Categories, Versions and Links,
+to a gzipped file with one json document per line.  import upserts a bundle into this environment's database
+in batched bulk writes, and then updates counts and the table of contents once.
+
+    python bundle.py export tanakh.ndjson.gz -c Tanakh/Torah -c Tanakh/Prophets --links 1
+    python bundle.py import tanakh.ndjson.gz
+
+The Sefaria model is set up when a bundle is exported or imported, not when this is imported.
+"""
+import argparse
+import gzip
+import os
+import sys
+
+from bson import json_util
+from pymongo import ReplaceOne
+
+from Move_Tanach import link_query
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import model
+
+BUNDLE_VERSION = 1
+
+# kind of record, collection, fields that identify a record.
+# A bundle holds each kind before the kinds that depend on it.
+KINDS = [
+    ("term", "term", ["name"]),
+    ("category", "category", ["path"]),
+    ("index", "index", ["title"]),
+    ("version", "texts", ["title", "versionTitle", "language"]),
+    ("link", "links", ["refs"]),
+]
+
+
+def _shared_titles(node):
+    titles = [node["sharedTitle"]] if node.get("sharedTitle") else []
+    for child in node.get("nodes", []):
+        titles += _shared_titles(child)
+    return titles
+
+
+def _category_query(path):
+    return {"categories.{}".format(i): c for i, c in enumerate(path)}
+
+
+def export(filename, category_paths, links=0):
+    """
+    :param category_paths: list of category paths.  Every index under each path is exported.
+    :param links: 0 for no links, 1 for manual links, 2 for all links
+    """
+    db = model.database()
+    indexes = []
+    seen = set()
+    for path in category_paths:
+        for index in db.index.find(_category_query(path)):
+            if index["title"] not in seen:
+                seen.add(index["title"])
+                indexes.append(index)
+
+    term_names = set()
+    needed_paths = set()
+    for index in indexes:
+        term_names.update(_shared_titles(index.get("schema", {})))
+        term_names.update(index.get("categories", []))
+        if index.get("collective_title"):
+            term_names.add(index["collective_title"])
+        for i in range(1, len(index.get("categories", [])) + 1):
+            needed_paths.add(tuple(index["categories"][:i]))
+    categories = list(db.category.find({"$or": [{"path": list(p)} for p in needed_paths]})) if needed_paths else []
+    term_names.update(c["sharedTitle"] for c in categories if c.get("sharedTitle"))
+
+    counts = {kind: 0 for kind, _, _ in KINDS}
+    with gzip.open(filename, "wb") as f:
+        def put(kind, doc):
+            f.write(json_util.dumps({"kind": kind, "doc": doc}) + "\n")
+            counts[kind] += 1
+
+        f.write(json_util.dumps({"kind": "bundle", "version": BUNDLE_VERSION, "categories": category_paths}) + "\n")
+        for term in db.term.find({"name": {"$in": sorted(term_names)}}):
+            put("term", term)
+        for category in sorted(categories, key=lambda c: len(c["path"])):
+            put("category", category)
+        for index in indexes:
+            put("index", index)
+        for index in indexes:
+            for version in db.texts.find({"title": index["title"]}):
+                put("version", version)
+        if links:
+            for index in indexes:
+                for link in db.links.find(link_query(index["title"], links), no_cursor_timeout=True).batch_size(1000):
+                    if not link.get("source_text_oid"):
+                        put("link", link)
+
+    for kind, _, _ in KINDS:
+        print "{}: {}".format(kind, counts[kind])
+
+
+def iter_bundle(filename):
+    with gzip.open(filename, "rb") as f:
+        header = json_util.loads(f.readline())
+        if header.get("kind") != "bundle" or header.get("version") != BUNDLE_VERSION:
+            raise ValueError("{} is not a version {} bundle".format(filename, BUNDLE_VERSION))
+        for line in f:
+            yield json_util.loads(line)
+
+
+def import_bundle(filename, batch_size=1000):
+    from common import bulk
+    db = model.database()
+    library = model.load().library
+    kinds = {kind: (collection, keys) for kind, collection, keys in KINDS}
+    titles = set()
+    pending = []
+    pending_kind = None
+
+    def flush():
+        if pending:
+            bulk.write(db[kinds[pending_kind][0]], pending, batch_size)
+        del pending[:]
+
+    for record in iter_bundle(filename):
+        kind, doc = record["kind"], record["doc"]
+        if kind not in kinds:
+            raise ValueError(u"Unknown kind of record: {}".format(kind))
+        if kind != pending_kind:
+            flush()
+            if pending_kind == "index":
+                # Versions and links are checked against the library
+                library.rebuild()
+            pending_kind = kind
+        # _ids belong to the source database.  Records are matched on their natural keys instead.
+        doc.pop("_id", None)
+        pending.append(ReplaceOne({k: doc[k] for k in kinds[kind][1]}, doc, upsert=True))
+        if len(pending) == batch_size:
+            flush()
+        if kind in ("index", "version"):
+            titles.add(doc["title"])
+    flush()
+    if pending_kind == "index":
+        library.rebuild()
+
+    bulk.refresh(titles)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    export_parser = subparsers.add_parser("export", help="Write a bundle from this environment")
+    export_parser.add_argument("bundle", help="Bundle file to write")
+    export_parser.add_argument("-c", "--category", action="append", required=True,
+                               help="Category path, with / between categories, e.g. Tanakh/Torah. May be repeated.")
+    export_parser.add_argument("-l", "--links", default=0, type=int,
+                               help="Enter '1' to include manual links, '2' to include auto links as well")
+    import_parser = subparsers.add_parser("import", help="Load a bundle into this environment")
+    import_parser.add_argument("bundle", help="Bundle file to read")
+    import_parser.add_argument("--batch-size", default=1000, type=int, help="Number of records per bulk write")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export(args.bundle, [c.split("/") for c in args.category], args.links)
+    else:
+        import_bundle(args.bundle, args.batch_size)
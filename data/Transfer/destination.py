@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+What the destination server is known to have, shared by every copier in a run.
+
+Terms and categories are looked up at most once each.  The answers, and whatever the copiers create,
+are remembered for the rest of the run, and can be saved as a snapshot to seed the next one.
+"""
+import json
+import threading
+
+
+def _answer(response):
+    """
+    :return: the json of a response that answers the lookup, or None.  Only a success or a 404 is an answer.
+        An error status that is left after the transport's retries, or a body that isn't json, says nothing
+        about what the destination has, so it mustn't be remembered.
+    """
+    if not (200 <= response.status_code < 300 or response.status_code == 404):
+        return None
+    try:
+        answer = response.json()
+    except ValueError:
+        return None
+    return answer if isinstance(answer, dict) else None
+
+
+class DestinationCache(object):
+    def __init__(self, transport, dest_server):
+        self._transport = transport
+        self._dest_server = dest_server
+        self._lock = threading.Lock()
+        self._terms = {}  # name -> whether the destination has it
+        self._categories = set()  # paths, as tuples, that the destination has
+        self._checked_categories = set()  # paths that have been looked up
+        self._categories_complete = False  # True when _categories lists every category on the destination
+
+    def seed_from_toc(self):
+        """Record every category on the destination, from one request for its table of contents."""
+        response = self._transport.get(u'{}/api/index'.format(self._dest_server))
+        try:
+            toc = response.json()
+        except ValueError:
+            return
+        if not isinstance(toc, list):
+            return
+
+        def walk(nodes, path):
+            for node in nodes:
+                if "category" in node:
+                    walk(node.get("contents", []), path + (node["category"],))
+                    self._add_category(path + (node["category"],))
+
+        with self._lock:
+            walk(toc, ())
+            self._categories_complete = True
+
+    def load_snapshot(self, filename):
+        with open(filename) as f:
+            snapshot = json.load(f)
+        with self._lock:
+            self._terms.update(snapshot.get("terms", {}))
+            for path in snapshot.get("categories", []):
+                self._add_category(tuple(path))
+                self._checked_categories.add(tuple(path))
+
+    def save_snapshot(self, filename):
+        with self._lock:
+            snapshot = {"terms": self._terms, "categories": sorted(list(p) for p in self._categories)}
+        with open(filename, "w") as f:
+            json.dump(snapshot, f, indent=1)
+
+    def has_term(self, name):
+        """
+        :return: whether the destination has the term, or None if its answer couldn't be read.
+            None isn't remembered, so the term is looked up again next time.
+        """
+        with self._lock:
+            if name in self._terms:
+                return self._terms[name]
+            answer = _answer(self._transport.get(u'{}/api/terms/{}'.format(self._dest_server, name)))
+            if answer is None:
+                return None
+            exists = answer.get('error', '') != "Term does not exist."
+            self._terms[name] = exists
+            return exists
+
+    def add_term(self, name):
+        with self._lock:
+            self._terms[name] = True
+
+    def existing_depth(self, path):
+        """
+        :return: length of the longest prefix of the category path that the destination has, or None if
+            the destination's answer couldn't be read
+        """
+        path = tuple(path)
+        with self._lock:
+            if path not in self._categories and not self._categories_complete and path not in self._checked_categories:
+                dest_category = _answer(self._transport.get(u'{}/api/category/{}'.format(
+                    self._dest_server, u'/'.join(path))))
+                if dest_category is None:
+                    return None
+                if dest_category.get('error') != u'Category not found':
+                    self._add_category(path)
+                elif dest_category.get('closest_parent'):
+                    self._add_category(tuple(dest_category['closest_parent']['path']))
+                self._checked_categories.add(path)
+            return max(i for i in range(len(path) + 1) if i == 0 or path[:i] in self._categories)
+
+    def add_category(self, path):
+        with self._lock:
+            self._add_category(tuple(path))
+
+    def _add_category(self, path):
+        # A category's parents exist as well
+        for i in range(1, len(path) + 1):
+            self._categories.add(path[:i])
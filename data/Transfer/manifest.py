@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Fingerprints of what has been posted to a destination, so that a later run can skip content that hasn't changed.
+
+The manifest is a json file of key -> sha1 of the posted payload, for one destination server.
+A payload is only recorded once the destination has accepted it.
+"""
+import hashlib
+import json
+import os
+import threading
+
+
+def fingerprint(payload):
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, separators=(",", ":"))).hexdigest()
+
+
+class Manifest(object):
+    def __init__(self, filename, dest_server):
+        self.filename = filename
+        self.dest_server = dest_server
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                data = json.load(f)
+            # A manifest for another server says nothing about this one
+            if data.get("destination") == dest_server:
+                self._entries = data.get("entries", {})
+
+    @staticmethod
+    def key(*parts):
+        return u"|".join(parts)
+
+    def changed(self, key, payload):
+        with self._lock:
+            return self._entries.get(key) != fingerprint(payload)
+
+    def record(self, key, payload):
+        with self._lock:
+            self._entries[key] = fingerprint(payload)
+
+    def save(self):
+        with self._lock:
+            data = {"destination": self.dest_server, "entries": self._entries}
+        tmp = self.filename + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=0, sort_keys=True)
+        os.rename(tmp, self.filename)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+A local stand-in for a destination server, for measuring the copier without a sandbox.
+
+Implements the endpoints that ServerTextCopier calls, keeping what's posted in memory:
+    GET  api/terms/<name>, api/category/<path>, api/index
+    POST api/terms/<name>, api/category, api/v2/raw/index/<title>, api/texts/<ref>,
+         api/version/flags/<title>/<lang>/<versionTitle>, api/links/
+Each request can be delayed, and a share of them answered with an error status, to see how the copier copes.
+
+    python standin_server.py [--port 8000] [--latency 0.05] [--error-rate 0.01]
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import urllib
+import urlparse
+import zlib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+class StandinState(object):
+    """What has been posted to the server, and counts of requests by endpoint"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.terms = {}
+        self.categories = {}  # path tuple -> contents
+        self.indexes = {}
+        self.texts = {}  # (ref, versionTitle, language) -> text
+        self.flags = {}
+        self.links = 0
+        self.counts_updated = 0
+        self.requests = {}
+        self.errors = 0
+
+    def count(self, method, path):
+        key = u"{} {}".format(method, u"/".join(path.split(u"/")[:2]))
+        self.requests[key] = self.requests.get(key, 0) + 1
+
+    def toc(self):
+        def tree(prefix):
+            children = sorted(set(p[len(prefix)] for p in self.categories
+                                  if len(p) > len(prefix) and p[:len(prefix)] == prefix))
+            return [{"category": c, "contents": tree(prefix + (c,))} for c in children]
+        return tree(())
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Buffer the response, so headers and body go out together rather than waiting on delayed acks
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _reply(self, obj, status=200, headers=None):
+        body = json.dumps(obj)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start(self, method):
+        """Apply latency and error injection.  :return: decoded path, or None if an error was sent"""
+        server = self.server
+        if server.latency or server.jitter:
+            time.sleep(server.latency + random.uniform(0, server.jitter))
+        path = urllib.unquote(urlparse.urlsplit(self.path).path).decode("utf-8").strip(u"/")
+        with server.state.lock:
+            server.state.count(method, path)
+        if server.error_rate and random.random() < server.error_rate:
+            with server.state.lock:
+                server.state.errors += 1
+            self._reply({"error": "Injected error"}, server.error_status, {"Retry-After": "1"})
+            return None
+        return path
+
+    def do_GET(self):
+        path = self._start("GET")
+        if path is None:
+            return
+        state = self.server.state
+        with state.lock:
+            if path.startswith(u"api/terms/"):
+                name = path[len(u"api/terms/"):]
+                return self._reply(state.terms.get(name) or {"error": "Term does not exist."})
+            if path.startswith(u"api/category/"):
+                categories = tuple(path[len(u"api/category/"):].split(u"/"))
+                if categories in state.categories:
+                    return self._reply(state.categories[categories])
+                result = {"error": "Category not found"}
+                parents = [p for p in state.categories if categories[:len(p)] == p]
+                if parents:
+                    result["closest_parent"] = {"path": list(max(parents, key=len))}
+                return self._reply(result)
+            if path == u"api/index":
+                return self._reply(state.toc())
+        self._reply({"error": "Unknown endpoint"}, 404)
+
+    def do_POST(self):
+        # Read the body before any injected error, so that it isn't left on the kept-alive connection
+        # to be taken for the next request
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = self._start("POST")
+        if path is None:
+            return
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        try:
+            payload = json.loads(urlparse.parse_qs(body)["json"][0])
+        except (KeyError, ValueError):
+            return self._reply({"error": "No json in request"}, 400)
+        query = urlparse.parse_qs(urlparse.urlsplit(self.path).query)
+
+        state = self.server.state
+        with state.lock:
+            if path.startswith(u"api/terms/"):
+                state.terms[path[len(u"api/terms/"):]] = payload
+            elif path == u"api/category":
+                state.categories[tuple(payload["path"])] = payload
+            elif path.startswith(u"api/v2/raw/index/"):
+                state.indexes[path[len(u"api/v2/raw/index/"):]] = payload
+            elif path.startswith(u"api/texts/"):
+                state.texts[(path[len(u"api/texts/"):], payload["versionTitle"], payload["language"])] = payload["text"]
+                if query.get("count_after") == ["1"]:
+                    state.counts_updated += 1
+            elif path.startswith(u"api/version/flags/"):
+                state.flags[path[len(u"api/version/flags/"):]] = payload
+            elif path == u"api/links":
+                state.links += len(payload)
+                return self._reply([{"status": "ok"}] * len(payload))
+            else:
+                return self._reply({"error": "Unknown endpoint"}, 404)
+        self._reply({"status": "ok"})
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), latency=0, jitter=0, error_rate=0, error_status=503, verbose=False):
+        """
+        :param address: (host, port).  Port 0 picks a free port.
+        :param latency: seconds to wait before answering each request
+        :param jitter: up to this many more seconds are added to each wait, at random
+        :param error_rate: share of requests to answer with error_status instead
+        """
+        HTTPServer.__init__(self, address, StandinHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.verbose = verbose
+        self.state = StandinState()
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def start(self):
+        """Serve on a background thread"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", default=8000, type=int)
+    parser.add_argument("--latency", default=0, type=float, help="Seconds to wait before answering each request")
+    parser.add_argument("--jitter", default=0, type=float, help="Up to this many more seconds of wait, at random")
+    parser.add_argument("--error-rate", default=0, type=float, help="Share of requests to answer with an error")
+    parser.add_argument("--error-status", default=503, type=int, help="Status of injected errors")
+    args = parser.parse_args()
+
+    server = StandinServer((args.host, args.port), args.latency, args.jitter, args.error_rate, args.error_status,
+                           verbose=True)
+    print "Serving on {}".format(server.url)
+    server.serve_forever()
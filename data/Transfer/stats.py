@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Where a transfer spends its time: requests by endpoint, and local work by phase.
+
+One TransferStats is shared by everything in a run, through the Transport.  summary() gives a json-able dict.
+"""
+import threading
+import time
+import urlparse
+from contextlib import contextmanager
+
+# Upper bounds of latency histogram buckets, in milliseconds
+BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+# Requests are grouped by the longest of these that their path starts with
+ENDPOINTS = ["api/v2/raw/index", "api/texts", "api/terms", "api/category", "api/version/flags", "api/links", "api/index"]
+
+
+def endpoint(method, url):
+    path = urlparse.urlsplit(url).path.lstrip("/")
+    for prefix in sorted(ENDPOINTS, key=len, reverse=True):
+        if path.startswith(prefix):
+            return u"{} {}".format(method, prefix)
+    return u"{} {}".format(method, u"/".join(path.split("/")[:2]))
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class EndpointStats(object):
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def summary(self):
+        ordered = sorted(self.latencies)
+        histogram = [0] * (len(BUCKETS_MS) + 1)
+        for seconds in ordered:
+            ms = seconds * 1000
+            histogram[next((i for i, bound in enumerate(BUCKETS_MS) if ms <= bound), len(BUCKETS_MS))] += 1
+        labels = ["<={}".format(b) for b in BUCKETS_MS] + [">{}".format(BUCKETS_MS[-1])]
+        result = {
+            "requests": len(ordered),
+            "errors": self.errors,
+            "retries": self.retries,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "seconds": round(sum(ordered), 3),
+            "histogram_ms": {label: n for label, n in zip(labels, histogram) if n},
+        }
+        if ordered:
+            result["latency_ms"] = {
+                "mean": round(sum(ordered) / len(ordered) * 1000, 1),
+                "p50": round(_percentile(ordered, .5) * 1000, 1),
+                "p90": round(_percentile(ordered, .9) * 1000, 1),
+                "p99": round(_percentile(ordered, .99) * 1000, 1),
+                "max": round(ordered[-1] * 1000, 1),
+            }
+        return result
+
+
+class TransferStats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._endpoints = {}
+        self._phases = {}
+
+    def _endpoint(self, method, url):
+        key = endpoint(method, url)
+        if key not in self._endpoints:
+            self._endpoints[key] = EndpointStats()
+        return self._endpoints[key]
+
+    def record_request(self, method, url, seconds, bytes_sent, bytes_received, status):
+        """:param status: HTTP status, or None if no response was received"""
+        with self._lock:
+            e = self._endpoint(method, url)
+            e.latencies.append(seconds)
+            e.bytes_sent += bytes_sent
+            e.bytes_received += bytes_received
+            if status is None or status >= 400:
+                e.errors += 1
+
+    def record_retry(self, method, url):
+        with self._lock:
+            self._endpoint(method, url).retries += 1
+
+    @contextmanager
+    def timer(self, phase):
+        """Add the time spent in the block to phase"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._phases[phase] = self._phases.get(phase, 0) + time.time() - start
+
+    def summary(self):
+        with self._lock:
+            endpoints = {key: e.summary() for key, e in self._endpoints.iteritems()}
+            phases = {phase: round(seconds, 3) for phase, seconds in self._phases.iteritems()}
+        # Requests overlap when they're made concurrently, so network seconds can add up to more than the wall time
+        return {
+            "wall_seconds": round(time.time() - self._start, 3),
+            "local_seconds": phases,
+            "network_seconds": round(sum(e["seconds"] for e in endpoints.values()), 3),
+            "requests": sum(e["requests"] for e in endpoints.values()),
+            "errors": sum(e["errors"] for e in endpoints.values()),
+            "retries": sum(e["retries"] for e in endpoints.values()),
+            "bytes_sent": sum(e["bytes_sent"] for e in endpoints.values()),
+            "bytes_received": sum(e["bytes_received"] for e in endpoints.values()),
+            "endpoints": endpoints,
+        }
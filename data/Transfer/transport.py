@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP transport for copying texts to another server.
+
+One Transport holds a pool of keep-alive connections, so that a run which makes thousands of requests
+to the same destination only opens a handful of connections.  Share one instance between copiers.
+
+Requests that fail transiently are retried with exponential backoff.  The transport can also hold
+requests to a fixed rate, and lowers the number of requests in flight when the destination shows
+signs of overload (429s, 5xxs, timeouts, slow responses), raising it again as requests succeed.
+Requests that fail for good are written to a ledger, which can be replayed later.
+"""
+import gzip
+import json
+import random
+import threading
+import time
+import urllib
+from cStringIO import StringIO
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from stats import TransferStats
+
+DEFAULT_POOL_SIZE = 10
+
+# Statuses that mean "try again later"
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+class TokenBucket(object):
+    """Allows rate requests a second on average, and bursts of up to burst"""
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, rate))
+        self._tokens = self.capacity
+        self._time = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.capacity, self._tokens + (now - self._time) * self.rate)
+                self._time = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveLimit(object):
+    """
+    Limit on the number of requests in flight, adjusted by additive increase, multiplicative decrease:
+    each success raises the limit by 1/limit, so by about one per round of requests, and
+    a sign of congestion halves it, at most once a second.
+    """
+    def __init__(self, maximum, minimum=1):
+        self.maximum = float(maximum)
+        self.minimum = float(minimum)
+        self.limit = self.maximum
+        self._in_flight = 0
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self, congested):
+        with self._condition:
+            self._in_flight -= 1
+            now = time.time()
+            if congested:
+                if now - self._last_decrease > 1:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class FailureLedger(object):
+    """Requests that failed for good, as lines of json, so that they can be replayed"""
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+
+    def record(self, method, url, values, status, error):
+        entry = {
+            "time": time.time(),
+            "method": method,
+            "url": url,
+            # The api key isn't kept.  It's supplied again on replay.
+            "values": {k: v for k, v in (values or {}).iteritems() if k != "apikey"},
+            "status": status,
+            "error": error,
+        }
+        with self._lock:
+            with open(self.filename, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    @staticmethod
+    def entries(filename):
+        with open(filename) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
+class Transport(object):
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, gzip_bodies=False, timeout=None, stats=None,
+                 retries=3, backoff=0.5, max_backoff=30, rate=None, burst=None, max_in_flight=None,
+                 latency_target=None, ledger=None):
+        """
+        :param pool_size: number of connections kept open to each host
+        :param gzip_bodies: compress POST bodies.  The destination must accept Content-Encoding: gzip.
+        :param timeout: seconds to wait for a connection or a response, or None to wait indefinitely
+        :param stats: TransferStats to record requests in
+        :param retries: number of times to retry an idempotent request after a connection error or a RETRY_STATUSES
+        :param backoff: seconds to wait before the first retry.  The wait doubles with each retry, up to max_backoff.
+        :param rate: maximum requests a second, or None for no limit
+        :param burst: number of requests that can be made at once under the rate limit
+        :param max_in_flight: most requests to have in flight at once.  The limit is lowered from here when the
+            destination is overloaded.  Defaults to pool_size.
+        :param latency_target: seconds.  Responses slower than this count as overload, as 429s and 5xxs do.
+        :param ledger: FailureLedger to record requests that fail for good in
+        """
+        self.gzip_bodies = gzip_bodies
+        self.timeout = timeout
+        self.stats = stats or TransferStats()
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rate_limit = TokenBucket(rate, burst) if rate else None
+        self.concurrency = AdaptiveLimit(max_in_flight or pool_size)
+        self.latency_target = latency_target
+        self.ledger = ledger
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get(self, url):
+        return self._request("GET", url)
+
+    def post(self, url, values, idempotent=True):
+        """
+        POST values as a urlencoded form
+        :param idempotent: whether the request can safely be retried
+        :return: requests.Response.  Error statuses are returned, not raised.
+        """
+        body = urllib.urlencode(values)
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        if self.gzip_bodies:
+            body = self._compress(body)
+            headers["Content-Encoding"] = "gzip"
+        return self._request("POST", url, data=body, headers=headers, idempotent=idempotent, values=values)
+
+    def _request(self, method, url, data=None, headers=None, idempotent=True, values=None):
+        attempts = self.retries + 1 if idempotent else 1
+        for attempt in range(attempts):
+            if attempt:
+                self.stats.record_retry(method, url)
+                time.sleep(wait)
+
+            response, error = self._attempt(method, url, data, headers)
+            if error is None and response.status_code not in RETRY_STATUSES:
+                break
+
+            wait = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(.5, 1)
+            retry_after = response.headers.get("Retry-After") if response is not None else None
+            if retry_after and retry_after.isdigit():
+                wait = max(wait, min(self.max_backoff, int(retry_after)))
+
+        if self.ledger and (error is not None or response.status_code >= 400):
+            self.ledger.record(method, url, values, response.status_code if response is not None else None,
+                               str(error) if error is not None else None)
+        if error is not None:
+            raise error
+        return response
+
+    def _attempt(self, method, url, data, headers):
+        """:return: (response, None), or (None, exception) on a connection error or timeout"""
+        if self.rate_limit:
+            self.rate_limit.acquire()
+        self.concurrency.acquire()
+        start = time.time()
+        response = None
+        error = None
+        try:
+            response = self.session.request(method, url, data=data, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            error = e
+        elapsed = time.time() - start
+
+        congested = error is not None or response.status_code == 429 or response.status_code >= 500 \
+            or (self.latency_target is not None and elapsed > self.latency_target)
+        self.concurrency.release(congested)
+        self.stats.record_request(method, url, elapsed, len(data or ""),
+                                  len(response.content) if response is not None else 0,
+                                  response.status_code if response is not None else None)
+        return response, error
+
+    @staticmethod
+    def _compress(body):
+        buf = StringIO()
+        with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+            f.write(body)
+        return buf.getvalue()
+
+    def close(self):
+        self.session.close()
+
+
+def replay(filename, transport, apikey=None):
+    """
+    Make the requests in a failure ledger again.  Those that still fail are recorded in the transport's ledger,
+    which should be a different file.
+    :return: number of requests that succeeded
+    """
+    succeeded = 0
+    for entry in FailureLedger.entries(filename):
+        try:
+            if entry["method"] == "GET":
+                response = transport.get(entry["url"])
+            else:
+                values = dict(entry["values"])
+                if apikey:
+                    values["apikey"] = apikey
+                response = transport.post(entry["url"], values)
+        except requests.RequestException as e:
+            print u"{} {}: {}".format(entry["method"], entry["url"], e)
+            continue
+        print u"{} {}: {}".format(entry["method"], entry["url"], response.status_code)
+        if response.status_code < 400:
+            succeeded += 1
+    return succeeded
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk write path for loaders.
+
+Instead of deleting and saving each Index and Version in turn, a BulkLoader collects every record for a run,
+validates each one the way save() would, and writes them with one unordered bulk upsert per collection.
+Counts and the table of contents are recomputed once, after everything is written.
+Sets up the Sefaria model when imported, so loaders import it from their writer stage.
+"""
+from pymongo import ReplaceOne
+
+from common import model
+model.load()
+from sefaria.model import *
+from sefaria.model.version_state import VersionState
+from sefaria.system.database import db
+
+
+def write(collection, operations, batch_size=1000):
+    """Run operations on collection in unordered bulk writes of up to batch_size"""
+    for i in range(0, len(operations), batch_size):
+        result = collection.bulk_write(operations[i:i + batch_size], ordered=False)
+        print "{}: {} inserted, {} replaced".format(collection.name, result.upserted_count, result.modified_count)
+
+
+def refresh(titles):
+    """Update counts for each title, and then the table of contents"""
+    for title in sorted(set(titles)):
+        VersionState(title).refresh()
+    library.rebuild_toc()
+
+
+def _document(record):
+    """Normalize and validate a record as save() does, and return the document that save() would write."""
+    record._normalize()
+    record._validate()
+    record._pre_save()
+    return record._saveable_attrs()
+
+
+class BulkLoader(object):
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self._indexes = []
+        self._versions = []
+
+    def add_index(self, index):
+        self._indexes += [index]
+
+    def add_version(self, version):
+        self._versions += [version]
+
+    def flush(self):
+        """Write everything collected so far, then update dependent records once."""
+        titles = [i.title for i in self._indexes] + [v.title for v in self._versions]
+
+        if self._indexes:
+            write(db.index, [ReplaceOne({"title": i.title}, _document(i), upsert=True) for i in self._indexes],
+                  self.batch_size)
+            # Versions are validated against the library, which needs to know about the new indexes
+            library.rebuild()
+
+        if self._versions:
+            write(db.texts, [
+                ReplaceOne({"title": v.title, "versionTitle": v.versionTitle, "language": v.language},
+                           _document(v), upsert=True)
+                for v in self._versions], self.batch_size)
+
+        refresh(titles)
+
+        self._indexes = []
+        self._versions = []
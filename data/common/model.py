@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+Sefaria's model layer, set up on first use.
+
+django.setup() and importing sefaria.model are slow, and connect to the database.
+Loaders call load() from the code that writes records, rather than at import,
+so that parsing, dry runs and worker processes don't pay for them.
+"""
+import threading
+
+_lock = threading.Lock()
+_model = None
+
+
+def load():
+    """Set up Django, once, and return the sefaria.model module"""
+    global _model
+    with _lock:
+        if _model is None:
+            import django
+            django.setup()
+            import sefaria.model
+            _model = sefaria.model
+    return _model
+
+
+def database():
+    """:return: the Sefaria mongo database"""
+    load()
+    from sefaria.system.database import db
+    return db
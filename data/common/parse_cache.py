@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of parsed texts, so that loaders can skip parsing when the source hasn't changed.
+
+Entries are keyed by a hash of the source file's contents and the parser's version,
+and stored as zlib compressed pickles.  When the cache grows past its size cap,
+the least recently used entries are removed.
+"""
+import cPickle as pickle
+import hashlib
+import os
+import tempfile
+import zlib
+
+DEFAULT_DIRECTORY = os.environ.get("S4ALL_PARSE_CACHE", os.path.expanduser("~/.cache/s4all/parse"))
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+SUFFIX = ".pkl.z"
+
+
+def file_hash(filename, chunk_size=1 << 20):
+    sha = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class ParseCache(object):
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, filename, parser_version, *extra):
+        """
+        :param filename: source file.  Only its contents are part of the key, not its name or path.
+        :param parser_version: change this whenever the parser's output changes
+        :param extra: anything else that affects the output, e.g. the citation scheme
+        """
+        parts = [file_hash(filename), str(parser_version)] + [unicode(e).encode("utf-8") for e in extra]
+        return hashlib.sha1("\0".join(parts)).hexdigest()
+
+    @staticmethod
+    def subkey(key, *extra):
+        """Key for one part of what key is for, e.g. one play of a file, without hashing the file again"""
+        return hashlib.sha1("\0".join([key] + [unicode(e).encode("utf-8") for e in extra])).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def get(self, key):
+        """Return the cached value, or None"""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.loads(zlib.decompress(f.read()))
+        except (IOError, OSError):
+            return None
+        except (zlib.error, pickle.UnpicklingError, EOFError, ValueError):
+            # Truncated or corrupt entry
+            self._remove(path)
+            return None
+        try:
+            os.utime(path, None)  # mark as recently used
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        data = zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        # Write to a temporary file and rename, so that concurrent readers never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(tmp, self._path(key))
+        self.evict()
+
+    def cached(self, key, parse, *args):
+        """Return the value for key, calling parse(*args) and storing the result on a miss."""
+        value = self.get(key)
+        if value is None:
+            value = parse(*args)
+            self.put(key, value)
+        return value
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries += [(stat.st_mtime, stat.st_size, path)]
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def clear(self):
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith(SUFFIX):
+                    self._remove(os.path.join(self.directory, name))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -1,12 +1,10 @@
 # -*- coding: utf-8 -*-
-import django
-django.setup()
-
-from sefaria.model import *
-from sefaria.system.database import db
+# Django and the Sefaria model are set up when the script runs, not when it's imported
 
 
 def create_category(en, he, parent=None):
+    from sefaria.model import Term, Category
+
     parent_path = parent.path if parent else []
 
     t = Term()
@@ -25,25 +23,38 @@ def create_category(en, he, parent=None):
     c.save(override_dependencies=True)
     return c
 
-db.category.remove({})
-db.term.remove({})
-
-for s in ["Act","Scene","Line","Book","Page","Paragraph","Chapter","Verse"]:
-    t = Term()
-    t.name = s
-    t.add_primary_titles(s, u"א" + s)
-    t.scheme = "section_names"
-    t.save()
 
-poetry = create_category("Poetry", u"שירה")
-prose = create_category("Fiction", u"פרוזה")
-nonfiction = create_category("Non Fiction", u"לא בדיוני")
-drama = create_category("Drama", u"דרמה")
-folklore = create_category("Folklore", u"פולקלור")
-philosophy = create_category("Philosophy", u"א")
-religious_texts = create_category("Religious Texts", u"ב")
-
-create_category("Shakespeare", u"שייקספיר", drama)
-cphil = create_category("Classical Philosophy", u"ג", philosophy)
-plato = create_category("Plato", u"ד", cphil)
-torah = create_category("Torah", u"תורה", religious_texts)
+def main():
+    import django
+    django.setup()
+    from sefaria.model import Term
+    from sefaria.system.database import db
+
+    db.category.remove({})
+    db.term.remove({})
+
+    for s in ["Act","Scene","Line","Book","Page","Paragraph","Chapter","Verse","Section"]:
+        t = Term()
+        t.name = s
+        t.add_primary_titles(s, u"א" + s)
+        t.scheme = "section_names"
+        t.save()
+
+    poetry = create_category("Poetry", u"שירה")
+    prose = create_category("Fiction", u"פרוזה")
+    nonfiction = create_category("Non Fiction", u"לא בדיוני")
+    drama = create_category("Drama", u"דרמה")
+    folklore = create_category("Folklore", u"פולקלור")
+    philosophy = create_category("Philosophy", u"א")
+    religious_texts = create_category("Religious Texts", u"ב")
+
+    create_category("Shakespeare", u"שייקספיר", drama)
+    cphil = create_category("Classical Philosophy", u"ג", philosophy)
+    plato = create_category("Plato", u"ד", cphil)
+    create_category("Homer", u"ה", poetry)
+    create_category("History", u"ו", nonfiction)
+    torah = create_category("Torah", u"תורה", religious_texts)
+
+
+if __name__ == '__main__':
+    main()